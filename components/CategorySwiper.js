@@ -9,10 +9,14 @@ import {
 } from 'react-native';
 import PagerView from 'react-native-pager-view';
 import StockCard from './StockCard';
+import { subscribe, applyDiff } from './stream';
 
 const { width } = Dimensions.get('window');
 const API = 'http://172.30.1.84:8000';
 
+// 마지막 /screen/all 응답 (ETag 와 본문). 다시 열 때 If-None-Match 로 304 를 받으면 그대로 사용
+let lastScreens = null;
+
 const CATEGORY_DEFS = [
   {
     title: '🚀 상승률 TOP10',
@@ -95,40 +99,72 @@ export default function CategorySwiper() {
   );
 
   useEffect(() => {
+    const screenName = (cat) => cat.path.split('/').pop();
+    const subscription = {
+      screens: Object.fromEntries(
+        CATEGORY_DEFS.map((cat) => [screenName(cat), { limit: 10 }])
+      ),
+    };
+    let unsubscribe = null;
+    let cancelled = false;
     (async () => {
-      await Promise.all(
-        CATEGORY_DEFS.map(async (cat, idx) => {
-          try {
-            const res = await fetch(`${API}${cat.path}?limit=10`);
-            if (!res.ok) {
-              const msg = await res.text();
-              throw new Error(`${res.status} ${msg.slice(0, 120)}`);
-            }
-            const json = await res.json();
-            setPages((prev) => {
-              const copy = [...prev];
-              copy[idx] = {
-                ...copy[idx],
-                data: json.data || [],
-                loading: false,
-                error: null,
-              };
-              return copy;
-            });
-          } catch (e) {
-            setPages((prev) => {
-              const copy = [...prev];
-              copy[idx] = {
-                ...copy[idx],
-                loading: false,
-                error: `불러오기 실패: ${String(e.message)}`,
-              };
-              return copy;
-            });
-          }
-        })
-      );
+      // 카테고리 10개를 요청 한 번으로 받아옴 (/screen/all)
+      try {
+        const body = JSON.stringify(subscription.screens);
+        const headers = { 'Content-Type': 'application/json' };
+        if (lastScreens && lastScreens.body === body) {
+          headers['If-None-Match'] = lastScreens.etag;
+        }
+        const res = await fetch(`${API}/screen/all`, { method: 'POST', headers, body });
+        let json;
+        if (res.status === 304) {
+          json = lastScreens.json;
+        } else if (!res.ok) {
+          const msg = await res.text();
+          throw new Error(`${res.status} ${msg.slice(0, 120)}`);
+        } else {
+          json = await res.json();
+          const etag = res.headers.get('ETag');
+          lastScreens = etag ? { body, etag, json } : null;
+        }
+        const results = json.data || {};
+        if (cancelled) return;
+        setPages((prev) =>
+          prev.map((page) => ({
+            ...page,
+            data: results[screenName(page)] || [],
+            loading: false,
+            error: null,
+          }))
+        );
+        // 이후 순위/가격 변경은 서버 푸시(diff)로 반영
+        unsubscribe = subscribe(subscription, (msg) => {
+          if (msg.type !== 'screen' && msg.type !== 'screen-diff') return;
+          setPages((prev) =>
+            prev.map((page) => {
+              if (screenName(page) !== msg.screen) return page;
+              const data =
+                msg.type === 'screen'
+                  ? msg.data
+                  : applyDiff(page.data, msg, 'ticker');
+              return { ...page, data };
+            })
+          );
+        });
+      } catch (e) {
+        setPages((prev) =>
+          prev.map((page) => ({
+            ...page,
+            loading: false,
+            error: `불러오기 실패: ${String(e.message)}`,
+          }))
+        );
+      }
     })();
+    return () => {
+      cancelled = true;
+      if (unsubscribe) unsubscribe();
+    };
   }, []);
 
   return (
@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { View, Text, StyleSheet, ActivityIndicator } from 'react-native';
+import { subscribe, applyDiff } from './stream';
 
 const API = 'http://172.30.1.84:8000'; // ← 각자 자기 PC IPv4 넣기
 
@@ -8,11 +9,23 @@ export default function MarketSummary() {
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
+    let unsubscribe = null;
+    let cancelled = false;
     const load = async () => {
       try {
         const res = await fetch(`${API}/market/summary`);
         const json = await res.json();
-        setMarketData(json.data || []);
+        const data = json.data || [];
+        if (cancelled) return;
+        setMarketData(data);
+        // 이후 값 변경은 서버 푸시로 받음
+        unsubscribe = subscribe({ indices: data.map((x) => x.name) }, (msg) => {
+          if (msg.type === 'index' || msg.type === 'index-diff') {
+            setMarketData((prev) =>
+              applyDiff(prev, { upsert: msg.data || msg.upsert }, 'name')
+            );
+          }
+        });
       } catch (e) {
         console.log('fetch error:', e);
       } finally {
@@ -20,6 +33,10 @@ export default function MarketSummary() {
       }
     };
     load();
+    return () => {
+      cancelled = true;
+      if (unsubscribe) unsubscribe();
+    };
   }, []);
 
   if (loading) {
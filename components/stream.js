@@ -0,0 +1,75 @@
+// components/stream.js
+// 서버 /stream 웹소켓 하나를 앱 전체가 공유해서 스크린/지수 갱신분(diff)만 받음.
+// 연결이 끊기면 잠시 후 재접속하고 지금까지의 구독을 다시 보냄.
+const API = 'http://172.30.1.84:8000'; // ← 각자 자기 PC IPv4 넣기
+const WS_URL = `${API.replace(/^http/, 'ws')}/stream`;
+const RECONNECT_MS = 5000;
+
+let socket = null;
+const listeners = new Set(); // { subscription, onMessage }
+
+function send(msg) {
+  if (socket && socket.readyState === WebSocket.OPEN) {
+    socket.send(JSON.stringify(msg));
+  }
+}
+
+function connect() {
+  const ws = new WebSocket(WS_URL);
+  socket = ws;
+  ws.onopen = () => {
+    listeners.forEach((l) => send({ subscribe: l.subscription }));
+  };
+  ws.onmessage = (e) => {
+    const msg = JSON.parse(e.data);
+    listeners.forEach((l) => l.onMessage(msg));
+  };
+  ws.onclose = () => {
+    if (socket !== ws) return;
+    socket = null;
+    setTimeout(() => {
+      if (!socket && listeners.size > 0) connect();
+    }, RECONNECT_MS);
+  };
+}
+
+// subscription: { screens: { 'top-gainers': { limit: 10 } }, indices: ['KOSPI'] }
+// 반환값을 호출하면 구독 해제
+export function subscribe(subscription, onMessage) {
+  const listener = { subscription, onMessage };
+  listeners.add(listener);
+  if (!socket) {
+    connect();
+  } else {
+    send({ subscribe: subscription });
+  }
+  return () => {
+    listeners.delete(listener);
+    send({
+      unsubscribe: {
+        screens: Object.keys(subscription.screens || {}),
+        indices: subscription.indices || [],
+      },
+    });
+    if (listeners.size === 0 && socket) {
+      const ws = socket;
+      socket = null;
+      ws.close();
+    }
+  };
+}
+
+// diff = { upsert: [...], remove: [key...], order: [key...] } 를 목록에 반영
+export function applyDiff(items, diff, key) {
+  const byKey = new Map(items.map((x) => [x[key], x]));
+  (diff.remove || []).forEach((k) => byKey.delete(k));
+  const added = [];
+  (diff.upsert || []).forEach((x) => {
+    if (!byKey.has(x[key])) added.push(x[key]);
+    byKey.set(x[key], x);
+  });
+  const order =
+    diff.order ||
+    items.map((x) => x[key]).filter((k) => byKey.has(k)).concat(added);
+  return order.map((k) => byKey.get(k)).filter(Boolean);
+}
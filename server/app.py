@@ -1,12 +1,28 @@
 # app.py
-from fastapi import FastAPI
+from fastapi import FastAPI, Body, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 import yfinance as yf
 from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import Any, Callable, List, Dict, Optional, Set, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pykrx import stock
 import pandas as pd
-import math
+import numpy as np
+import ast
+import asyncio
+import bisect
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 app.add_middleware(
@@ -17,6 +33,107 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ===== 계측 =====
+# pykrx/yfinance 호출마다 호출 수·소요 시간을 기록하고, 요청별 업스트림 호출 수와
+# 엔드포인트별 지연 분포를 /metrics 로 노출한다. (X-Upstream-Calls 응답 헤더도 추가)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_request_upstream: contextvars.ContextVar = contextvars.ContextVar("request_upstream", default=None)
+_metrics_lock = threading.Lock()
+_upstream_stats: Dict[str, Dict[str, float]] = {}
+_endpoint_stats: Dict[str, Dict[str, Any]] = {}
+
+def _record_upstream(label: str, seconds: float, failed: bool) -> None:
+    counter = _request_upstream.get()
+    with _metrics_lock:
+        s = _upstream_stats.setdefault(label, {"calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+        s["calls"] += 1
+        s["errors"] += int(failed)
+        s["seconds"] += seconds
+        s["max_seconds"] = max(s["max_seconds"], seconds)
+        if counter is not None:
+            counter["calls"] += 1
+
+def _record_request(path: str, seconds: float, upstream_calls: int) -> None:
+    ms = seconds * 1000.0
+    with _metrics_lock:
+        s = _endpoint_stats.setdefault(path, {
+            "count": 0, "upstream_calls": 0, "seconds": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        })
+        s["count"] += 1
+        s["upstream_calls"] += upstream_calls
+        s["seconds"] += seconds
+        s["buckets"][bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+class _Upstream:
+    """모듈 프록시: 함수 속성을 꺼낼 때 호출 계측 래퍼로 감싸서 돌려줌"""
+
+    def __init__(self, module, prefix: str):
+        self._module = module
+        self._prefix = prefix
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._module, name)
+        if not callable(attr) or isinstance(attr, type):
+            return attr
+        label = f"{self._prefix}.{name}"
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            t0 = time.perf_counter()
+            failed = True
+            try:
+                out = attr(*args, **kwargs)
+                failed = False
+                return out
+            finally:
+                _record_upstream(label, time.perf_counter() - t0, failed)
+        return call
+
+stock = _Upstream(stock, "pykrx")
+yf = _Upstream(yf, "yfinance")
+
+@app.middleware("http")
+async def _measure_request(request: Request, call_next):
+    counter = {"calls": 0}
+    token = _request_upstream.set(counter)
+    t0 = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _request_upstream.reset(token)
+    # 라우트가 없는 요청(404 스캔 등)은 한 항목으로 묶어서 /metrics 가 경로 수만큼 늘지 않게
+    route = request.scope.get("route")
+    _record_request(getattr(route, "path", "<unmatched>"), time.perf_counter() - t0, counter["calls"])
+    response.headers["X-Upstream-Calls"] = str(counter["calls"])
+    return response
+
+@app.get("/metrics")
+def metrics():
+    with _metrics_lock:
+        upstream = {
+            label: {
+                "calls": int(s["calls"]),
+                "errors": int(s["errors"]),
+                "total_ms": round(s["seconds"] * 1000.0, 2),
+                "avg_ms": round(s["seconds"] * 1000.0 / s["calls"], 2) if s["calls"] else 0.0,
+                "max_ms": round(s["max_seconds"] * 1000.0, 2),
+            }
+            for label, s in sorted(_upstream_stats.items())
+        }
+        endpoints = {
+            path: {
+                "count": s["count"],
+                "upstream_calls": s["upstream_calls"],
+                "upstream_calls_per_request": round(s["upstream_calls"] / s["count"], 3),
+                "mean_ms": round(s["seconds"] * 1000.0 / s["count"], 2),
+                # 버킷별 건수 (상한 ms, 마지막은 그 이상)
+                "histogram_ms": dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ["+Inf"], s["buckets"])),
+            }
+            for path, s in sorted(_endpoint_stats.items())
+        }
+    return {"upstream": upstream, "endpoints": endpoints}
+
 # ===== 시장 현황 =====
 INDEX_MAP = {
     "KOSPI":  {"symbol": "^KS11"},
@@ -24,278 +141,1506 @@ INDEX_MAP = {
     "NASDAQ": {"symbol": "^IXIC"},
 }
 
-def last_price_and_change(symbol: str):
-    tkr = yf.Ticker(symbol)
-    df = tkr.history(period="10d", interval="1d", auto_adjust=False).dropna()
-    if len(df) == 0:
+MARKET_SUMMARY_TTL_SEC = 60   # 백그라운드 갱신 주기(초)
+MARKET_SUMMARY_MAX_AGE_SEC = 300   # 갱신이 계속 실패하면 이보다 오래된 값은 내보내지 않고 직접 다시 받음
+
+_market_summary: Dict[str, Any] = {"data": None, "updated_at": 0.0}
+_market_summary_task: Optional[asyncio.Task] = None
+_market_summary_lock = threading.Lock()   # 요청 경로의 직접 조회는 동시에 하나만
+
+def _change_from_closes(closes: pd.Series):
+    closes = closes.dropna().astype(float)
+    if len(closes) == 0:
         return None, None
-    closes = df["Close"].astype(float)
     prev_close = float(closes.iloc[-2]) if len(closes) >= 2 else float(closes.iloc[-1])
     last_close = float(closes.iloc[-1])
     pct = ((last_close - prev_close) / prev_close * 100.0) if prev_close else 0.0
     return round(last_close, 2), round(pct, 2)
 
-@app.get("/market/summary")
-def market_summary():
+def refresh_market_summary() -> List[Dict]:
+    # INDEX_MAP 전체를 한 번의 다운로드로 받음 (지수 개수와 무관하게 요청 1회)
+    symbols = [meta["symbol"] for meta in INDEX_MAP.values()]
+    df = yf.download(
+        symbols, period="10d", interval="1d", auto_adjust=False,
+        group_by="column", progress=False, threads=True,
+    )
+    closes = df["Close"] if df is not None and not df.empty else pd.DataFrame()
+    if isinstance(closes, pd.Series):  # 심볼 하나면 단일 컬럼으로 올 수 있음
+        closes = closes.to_frame(symbols[0])
+
     result = []
     for idx, (name, meta) in enumerate(INDEX_MAP.items(), start=1):
-        value, change = last_price_and_change(meta["symbol"])
+        if meta["symbol"] not in closes.columns:
+            continue
+        value, change = _change_from_closes(closes[meta["symbol"]])
         if value is None:
             continue
         result.append({"id": str(idx), "name": name, "value": value, "change": change})
-    return {"data": result}
+
+    # yfinance 는 실패해도 예외 대신 빈/NaN 프레임을 주는 경우가 많음 → 이전 값을 덮어쓰지 않음
+    missing = {x["name"] for x in _market_summary["data"] or []} - {x["name"] for x in result}
+    if not result or missing:
+        raise RuntimeError(f"incomplete market data (missing: {', '.join(sorted(missing)) or 'all'})")
+    _market_summary.update(data=result, updated_at=time.time())
+    return result
+
+async def _market_summary_loop():
+    while True:
+        try:
+            await asyncio.to_thread(refresh_market_summary)
+        except Exception:  # 일시적인 Yahoo 오류: 이전 값 유지 후 다음 주기에 재시도
+            logger.exception("market summary refresh failed")
+        await asyncio.sleep(MARKET_SUMMARY_TTL_SEC)
+
+@app.on_event("startup")
+async def _start_market_summary():
+    global _market_summary_task
+    _market_summary_task = asyncio.create_task(_market_summary_loop())
+
+@app.on_event("shutdown")
+async def _stop_market_summary():
+    if _market_summary_task is not None:
+        _market_summary_task.cancel()
+
+def _fresh_market_summary() -> Optional[List[Dict]]:
+    if time.time() - _market_summary["updated_at"] > MARKET_SUMMARY_MAX_AGE_SEC:
+        return None
+    return _market_summary["data"]
+
+@app.get("/market/summary")
+def market_summary():
+    # 백그라운드 작업이 채워 둔 값을 그대로 반환. 첫 갱신 전이거나 너무 오래됐으면 직접 받아옴
+    data = _fresh_market_summary()
+    if data is None:
+        with _market_summary_lock:
+            data = _fresh_market_summary()  # 기다리는 동안 다른 요청이 받아 왔으면 그대로 사용
+            if data is None:
+                try:
+                    data = refresh_market_summary()
+                except Exception:
+                    logger.exception("market summary fetch failed")
+                    raise HTTPException(status_code=503, detail="market data unavailable")
+    return {"data": data}
 
 # ===== 공통 유틸 =====
 def today(fmt="%Y%m%d"):
     return datetime.now().strftime(fmt)
 
-def kospi_ohlcv(d=None):
-    base = datetime.now() if d is None else datetime.strptime(d, "%Y%m%d")
-    for k in range(0, 6):  # 당일부터 최대 5일 전까지 영업일 fallback
-        dd = (base - timedelta(days=k)).strftime("%Y%m%d")
-        df = stock.get_market_ohlcv_by_ticker(dd, market="KOSPI")
-        if df is not None and not df.empty:
-            return df
-    return stock.get_market_ohlcv_by_ticker(today(), market="KOSPI")
-
-def recent_bdays(n=4, max_back_days: int = 120) -> list[str]:
-    dates = []
-    day = 0
-    while len(dates) < n and day < max_back_days:  # 충분히 뒤로 탐색
-        d = (datetime.now() - timedelta(days=day)).strftime("%Y%m%d")
-        df = stock.get_market_ohlcv_by_ticker(d, market="KOSPI")
-        if df is not None and not df.empty:
-            dates.append(d)
-        day += 1
-    return sorted(dates)[-n:]
-
-def _as_int(x, default=0):
+# ===== 일별 스냅샷 저장소 =====
+# 거래일 × 시장별로 OHLCV + 시가총액 + 펀더멘털을 한 번만 받아서
+# 컬럼 단위 바이너리 파일 하나로 저장하고, 읽을 때는 memmap으로 연다.
+# (여러 워커 프로세스가 OS 페이지 캐시의 같은 사본을 공유)
+DATA_DIR = os.environ.get(
+    "STOCKAPP_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+)
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshots")
+LIVE_TTL_SEC = 60          # 확정 전(당일 장중) 스냅샷 재조회 주기(초)
+SESSION_CLOSE_HOUR = 18    # 이 시각 이후의 당일 데이터는 확정으로 보고 디스크에 저장
+MARKETS = ("KOSPI", "KOSDAQ")   # market="ALL" 은 이 시장들을 합친 스냅샷
+INGEST_WORKERS = 8         # (시장 × 테이블) 동시 조회 스레드 수
+SNAPSHOT_CACHE_SIZE = 256  # 메모리에 열어 두는 (시장, 거래일) 스냅샷 수. memmap 하나가 fd 하나를 잡음
+
+INT_COLS = ["시가", "고가", "저가", "종가", "거래량", "거래대금", "시가총액", "상장주식수", "BPS", "EPS", "DPS"]
+FLOAT_COLS = ["등락률", "PER", "PBR", "DIV"]
+# OHLCV/시총/펀더멘털 세 테이블이 모두 들어왔는지 확인하는 컬럼.
+# pykrx 는 KRX 오류를 빈 DataFrame 으로 돌려주므로, 하나라도 빠진 스냅샷은 디스크에 남기지 않음
+REQUIRED_COLS = ("종가", "거래량", "시가총액", "PER", "PBR", "DIV")
+
+_SNAP_MAGIC = b"SNAP1\n"
+_SNAP_ALIGN = 64
+
+_snapshots: "OrderedDict[Tuple[str, str], Tuple[Optional[float], pd.DataFrame]]" = OrderedDict()
+_snapshot_locks: Dict[Tuple[str, str], threading.Lock] = {}
+_snapshot_guard = threading.Lock()
+_combined: "OrderedDict[str, Tuple[tuple, pd.DataFrame]]" = OrderedDict()
+_ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+
+def _snapshot_path(d: str, market: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, market, f"{d}.snap")
+
+def _is_final(d: str) -> bool:
+    # 지난 거래일, 또는 장 마감 후의 당일 데이터는 더 이상 바뀌지 않음
+    now = datetime.now()
+    t = now.strftime("%Y%m%d")
+    return d < t or (d == t and now.hour >= SESSION_CLOSE_HOUR)
+
+def _downcast(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    cols = {}
+    i32 = np.iinfo(np.int32)
+    for c in INT_COLS:
+        if c not in df.columns:
+            continue
+        v = pd.to_numeric(df[c], errors="coerce").fillna(0).to_numpy(dtype=np.int64)
+        fits = len(v) == 0 or (v.min() >= i32.min and v.max() <= i32.max)
+        cols[c] = v.astype(np.int32) if fits else v
+    for c in FLOAT_COLS:
+        if c not in df.columns:
+            continue
+        cols[c] = pd.to_numeric(df[c], errors="coerce").to_numpy(dtype=np.float32)
+    return cols
+
+def _write_snapshot(path: str, df: pd.DataFrame) -> None:
+    # 포맷: MAGIC | 헤더 길이(uint32) | 헤더 JSON | (64바이트 정렬된) 컬럼 블록들
+    cols = _downcast(df)
+    layout, offset = [], 0
+    for name, arr in cols.items():
+        layout.append({"name": name, "dtype": arr.dtype.str, "offset": offset})
+        offset += -(-arr.nbytes // _SNAP_ALIGN) * _SNAP_ALIGN
+    header = json.dumps(
+        {"tickers": [str(t) for t in df.index], "columns": layout}, ensure_ascii=False
+    ).encode("utf-8")
+    data_start = -(-(len(_SNAP_MAGIC) + 4 + len(header)) // _SNAP_ALIGN) * _SNAP_ALIGN
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_SNAP_MAGIC)
+        f.write(np.uint32(len(header)).tobytes())
+        f.write(header)
+        for meta, arr in zip(layout, cols.values()):
+            f.seek(data_start + meta["offset"])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)  # 다른 워커가 반쯤 쓰인 파일을 읽지 않도록 원자적 교체
+
+def _read_snapshot(path: str) -> pd.DataFrame:
+    with open(path, "rb") as f:
+        if f.read(len(_SNAP_MAGIC)) != _SNAP_MAGIC:
+            raise ValueError(f"not a snapshot file: {path}")
+        hlen = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(hlen).decode("utf-8"))
+    tickers = header["tickers"]
+    if not tickers:
+        return pd.DataFrame()
+    data_start = -(-(len(_SNAP_MAGIC) + 4 + hlen) // _SNAP_ALIGN) * _SNAP_ALIGN
+    mm = np.memmap(path, mode="r", dtype=np.uint8)
+    cols = {
+        meta["name"]: np.frombuffer(
+            mm, dtype=np.dtype(meta["dtype"]), count=len(tickers), offset=data_start + meta["offset"]
+        )
+        for meta in header["columns"]
+    }
+    return pd.DataFrame(cols, index=pd.Index(tickers, name="티커"), copy=False)
+
+def _is_complete(df: pd.DataFrame) -> bool:
+    # 캘린더가 거래일만 넘겨 주므로 빈 스냅샷도 휴장일이 아니라 조회 실패
+    return not df.empty and all(c in df.columns for c in REQUIRED_COLS)
+
+def _merge_tables(ohlcv: pd.DataFrame, *extras: pd.DataFrame) -> pd.DataFrame:
+    # 장 시작 전(또는 조회 실패)에는 비어 있거나 거래량이 전부 0
+    if ohlcv is None or ohlcv.empty or not (ohlcv["거래량"] > 0).any():
+        return pd.DataFrame()
+    df = ohlcv
+    for extra in extras:
+        if extra is None or extra.empty:
+            continue
+        cols = [c for c in extra.columns if c not in df.columns]
+        df = df.join(extra[cols], how="left")
+    cols = _downcast(df)
+    return pd.DataFrame(cols, index=pd.Index(df.index.astype(str), name="티커"))
+
+def _fetch_snapshots(d: str, markets: List[str]) -> Dict[str, pd.DataFrame]:
+    # 시장별 OHLCV/시총/펀더멘털 조회를 전부 스레드 풀에 올려서 동시에 받음
+    # → 시장이 늘어도 대기 시간은 가장 느린 조회 하나 수준
+    tables = (stock.get_market_ohlcv_by_ticker, stock.get_market_cap_by_ticker, stock.get_market_fundamental)
+    # (요청별 업스트림 호출 집계를 위해 현재 컨텍스트를 그대로 넘김)
+    jobs = {
+        m: [_ingest_pool.submit(contextvars.copy_context().run, fn, d, market=m) for fn in tables]
+        for m in markets
+    }
+    return {m: _merge_tables(*(job.result() for job in futures)) for m, futures in jobs.items()}
+
+def _snapshot_lock(key: Tuple[str, str]) -> threading.Lock:
+    with _snapshot_guard:
+        return _snapshot_locks.setdefault(key, threading.Lock())
+
+def _cached_snapshot(key: Tuple[str, str]) -> Optional[pd.DataFrame]:
+    with _snapshot_guard:
+        hit = _snapshots.get(key)
+        if hit is not None:
+            _snapshots.move_to_end(key)
+    if hit is None:
+        return None
+    fetched_at, df = hit
+    if fetched_at is None:
+        return df
+    # 장중에 받은 스냅샷은 장 마감 이후로는 TTL 과 무관하게 다시 받음 (확정 데이터로 교체)
+    close = datetime.strptime(key[1], "%Y%m%d").replace(hour=SESSION_CLOSE_HOUR).timestamp()
+    if fetched_at < close <= time.time():
+        return None
+    return df if time.time() - fetched_at < LIVE_TTL_SEC else None
+
+def _lru_put(cache: OrderedDict, key, value) -> None:
+    # 오래 안 쓴 항목부터 내보냄 (내보낸 memmap 은 참조가 없어지면 fd 와 함께 닫힘)
+    with _snapshot_guard:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > SNAPSHOT_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def load_snapshots(d: str, markets) -> Dict[str, pd.DataFrame]:
+    """d 거래일의 시장별 스냅샷. 메모리/디스크에 없는 시장만 한꺼번에 조회."""
+    out = {m: _cached_snapshot((m, d)) for m in markets}
+    missing = sorted(m for m, df in out.items() if df is None)
+    if not missing:
+        return out
+    locks = [_snapshot_lock((m, d)) for m in missing]  # 같은 날짜를 동시에 여러 번 받지 않도록
+    for lock in locks:  # 항상 정렬된 순서로 잡아 교착 방지
+        lock.acquire()
     try:
-        return default if x is None or (isinstance(x, float) and math.isnan(x)) else int(x)
-    except Exception:
-        return default
+        need = []
+        for m in missing:
+            df = _cached_snapshot((m, d))
+            if df is None and os.path.exists(_snapshot_path(d, m)):
+                df = _read_snapshot(_snapshot_path(d, m))
+                if _is_complete(df):
+                    _lru_put(_snapshots, (m, d), (None, df))
+                else:  # 예전에 일부 테이블이 빠진 채 저장된 파일은 다시 받음
+                    df = None
+            if df is None:
+                need.append(m)
+            out[m] = df
+        for m, df in (_fetch_snapshots(d, need) if need else {}).items():
+            if _is_final(d) and _is_complete(df):
+                path = _snapshot_path(d, m)
+                _write_snapshot(path, df)
+                df, fetched_at = _read_snapshot(path), None
+            else:  # 장중이거나 일부 테이블 조회가 실패한 경우: 메모리에만 두고 LIVE_TTL_SEC 후 재조회
+                fetched_at = time.time()
+            _lru_put(_snapshots, (m, d), (fetched_at, df))
+            out[m] = df
+    finally:
+        for lock in locks:
+            lock.release()
+    return out
+
+def snapshot(d: str, market: str = "KOSPI") -> pd.DataFrame:
+    """d(YYYYMMDD) 거래일의 전 종목 OHLCV/시총/펀더멘털. 조회에 실패하면 빈 DataFrame."""
+    if market != "ALL":
+        return load_snapshots(d, [market])[market]
+    parts = load_snapshots(d, MARKETS)
+    # 시장별 스냅샷이 그대로면 합친 결과도 재사용
+    ids = tuple(id(parts[m]) for m in MARKETS)
+    with _snapshot_guard:
+        hit = _combined.get(d)
+    if hit is not None and hit[0] == ids:
+        return hit[1]
+    frames = [parts[m] for m in MARKETS if not parts[m].empty]
+    df = pd.concat(frames) if frames else pd.DataFrame()
+    _lru_put(_combined, d, (ids, df))
+    return df
 
-def _as_float(x, default=0.0):
+# ===== 거래일 캘린더 =====
+# KOSPI 지수 일봉의 날짜 = 거래일. 정렬된 거래일 목록을 한 번 만들어 두고
+# 필요한 구간만 앞/뒤로 늘려 가며, "D 이전 최근 N 거래일"은 이분 탐색으로 찾는다.
+CALENDAR_PATH = os.path.join(DATA_DIR, "calendar.json")
+CALENDAR_INDEX = "1001"       # KOSPI 지수 코드
+CALENDAR_INIT_DAYS = 400      # 처음 만들 때 당겨오는 기간(달력일)
+CALENDAR_MIN = "19950502"     # 더 과거로는 확장하지 않음
+
+# start~through 구간은 확정. dates 끝에 through 이후(장중 당일)가 붙어 있을 수 있음
+_calendar = {"start": None, "through": None, "dates": [], "checked_at": 0.0}
+_calendar_lock = threading.Lock()
+
+def _shift(d: str, days: int) -> str:
+    return (datetime.strptime(d, "%Y%m%d") + timedelta(days=days)).strftime("%Y%m%d")
+
+def _fetch_bdays(start: str, end: str) -> list[str]:
+    df = stock.get_index_ohlcv_by_date(start, end, CALENDAR_INDEX)
+    if df is None or df.empty:
+        return []
+    return sorted(pd.Timestamp(x).strftime("%Y%m%d") for x in df.index)
+
+def _load_calendar() -> None:
+    if _calendar["start"] is not None or not os.path.exists(CALENDAR_PATH):
+        return
+    with open(CALENDAR_PATH, encoding="utf-8") as f:
+        saved = json.load(f)
+    _calendar.update(start=saved["start"], through=saved["through"], dates=saved["dates"])
+
+def _save_calendar() -> None:
+    through = _calendar["through"]
+    saved = {
+        "start": _calendar["start"],
+        "through": through,
+        "dates": [x for x in _calendar["dates"] if x <= through],  # 확정분만 저장
+    }
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp = f"{CALENDAR_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(saved, f)
+    os.replace(tmp, CALENDAR_PATH)
+
+def _extend_calendar_forward(end: str) -> None:
+    cal = _calendar
+    if cal["through"] is not None:
+        if cal["through"] >= end:
+            return
+        # 남은 게 장중 당일뿐이면 LIVE_TTL_SEC 동안은 다시 묻지 않음
+        if cal["through"] == _shift(end, -1) and time.time() - cal["checked_at"] < LIVE_TTL_SEC:
+            return
+        start = _shift(cal["through"], 1)
+    else:
+        start = max(_shift(end, -CALENDAR_INIT_DAYS), CALENDAR_MIN)
+        cal["start"] = start
+    while cal["dates"] and cal["through"] is not None and cal["dates"][-1] > cal["through"]:
+        cal["dates"].pop()  # 지난번에 붙였던 미확정 당일 제거 후 다시 확인
+    cal["dates"].extend(x for x in _fetch_bdays(start, end) if x >= start)
+    cal["through"] = end if _is_final(end) else _shift(end, -1)
+    cal["checked_at"] = time.time()
+    _save_calendar()
+
+def _extend_calendar_back(start: str) -> None:
+    cal = _calendar
+    start = max(start, CALENDAR_MIN)
+    if start >= cal["start"]:
+        return
+    older = [x for x in _fetch_bdays(start, _shift(cal["start"], -1)) if x < cal["start"]]
+    cal["dates"][:0] = older
+    cal["start"] = start
+    _save_calendar()
+
+def bdays_before(d: Optional[str] = None, n: int = 1) -> list[str]:
+    """d(포함) 이전의 최근 n 거래일 (오름차순). d 생략 시 오늘 기준."""
+    d = min(d or today(), today())
+    with _calendar_lock:
+        _load_calendar()
+        _extend_calendar_forward(d)
+        dates = _calendar["dates"]
+        i = bisect.bisect_right(dates, d)
+        while i < n and _calendar["start"] > CALENDAR_MIN:
+            # 앞쪽이 모자라면 필요한 만큼(주말/휴일 여유 포함) 과거로 확장
+            _extend_calendar_back(_shift(min(d, _calendar["start"]), -max(2 * (n - i) + 10, 30)))
+            i = bisect.bisect_right(dates, d)
+        return dates[max(0, i - n):i]
+
+def kospi_ohlcv(d=None):
+    # d(포함) 이전의 마지막 거래일 스냅샷
+    ds = bdays_before(d, 1)
+    return snapshot(ds[-1]) if ds else pd.DataFrame()
+
+def recent_bdays(n=4) -> list[str]:
+    return bdays_before(today(), n)
+
+# ===== 거래일 × 종목 패널 =====
+# 여러 거래일 스냅샷의 한 컬럼을 (dates × tickers) 행렬로 모아 두고
+# 멀티데이 지표(변동성, 연속 상승 등)를 종목 루프 없이 한 번에 계산한다.
+PANEL_CACHE_SIZE = 32
+
+_panels: "OrderedDict[tuple, pd.DataFrame]" = OrderedDict()
+_panel_lock = threading.Lock()
+
+def panel(field: str, dates: List[str], market: str = "KOSPI") -> pd.DataFrame:
+    """dates × tickers 패널(float32). 해당 날짜에 없는 종목은 NaN."""
+    # 확정된 거래일은 바뀌지 않음. 장중 스냅샷은 갱신(TTL)되면 객체가 바뀌므로 id로 캐시 무효화
+    live = tuple(id(snapshot(d, market)) for d in dates if not _is_final(d))
+    key = (market, field, tuple(dates), live)
+    with _panel_lock:
+        if key in _panels:
+            _panels.move_to_end(key)
+            return _panels[key]
+
+    # 날짜별로 컬럼만 복사해 두고 스냅샷(memmap)은 바로 놓아서 긴 구간에서도 fd 를 쌓지 않음
+    tickers = pd.Index([], dtype=object)
+    cols = []
+    for d in dates:
+        f = snapshot(d, market)
+        if f.empty or field not in f.columns:
+            cols.append(None)
+            continue
+        cols.append((f.index, np.array(f[field].to_numpy(), dtype=np.float32)))
+        tickers = tickers.union(f.index)
+    values = np.full((len(dates), len(tickers)), np.nan, dtype=np.float32)
+    for i, col in enumerate(cols):
+        if col is not None:
+            values[i, tickers.get_indexer(col[0])] = col[1]
+    out = pd.DataFrame(values, index=pd.Index(dates, name="날짜"), columns=tickers)
+
+    with _panel_lock:
+        _panels[key] = out
+        while len(_panels) > PANEL_CACHE_SIZE:
+            _panels.popitem(last=False)
+    return out
+
+def rolling_std(values: np.ndarray, window: int) -> np.ndarray:
+    """(T, N) 행렬의 열별 이동 표준편차(ddof=0). 창 안에 결측이 있으면 NaN."""
+    x = values.astype(np.float64)
+    valid = ~np.isnan(x)
+    x = np.where(valid, x, 0.0)
+    pad = np.zeros((1, x.shape[1]))
+    c1 = np.cumsum(np.vstack([pad, x]), axis=0)
+    c2 = np.cumsum(np.vstack([pad, x * x]), axis=0)
+    cn = np.cumsum(np.vstack([pad, valid]), axis=0)
+    out = np.full(x.shape, np.nan)
+    if window <= 0 or window > x.shape[0]:
+        return out
+    s1 = c1[window:] - c1[:-window]
+    s2 = c2[window:] - c2[:-window]
+    full = (cn[window:] - cn[:-window]) == window
+    mean = s1 / window
+    var = np.maximum(s2 / window - mean * mean, 0.0)
+    out[window - 1:] = np.where(full, np.sqrt(var), np.nan)
+    return out
+
+# ===== 종목명 =====
+# 티커 → 종목명 사전. 시장별 최신 스냅샷의 전 종목을 한 번에 채워 두고
+# (data/names.json 으로 저장) 신규 상장 등 새 티커가 보일 때만 추가 조회.
+# 사명 변경은 티커가 그대로라 보이지 않으므로, NAMES_TTL_SEC 보다 오래된 이름은 백그라운드에서 다시 조회.
+NAMES_PATH = os.path.join(DATA_DIR, "names.json")
+NAMES_TTL_SEC = 24 * 3600
+
+_names: Dict[str, str] = {}
+_names_at: Dict[str, float] = {}      # 티커별 마지막 조회 시각
+_names_loaded = False
+_names_checked: Dict[str, str] = {}   # 시장 → 마지막으로 상장 종목을 확인한 거래일
+_names_refresh: Optional[threading.Thread] = None
+_names_lock = threading.Lock()
+
+def _save_names() -> None:
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp = f"{NAMES_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"names": _names, "updated_at": _names_at}, f, ensure_ascii=False)
+    os.replace(tmp, NAMES_PATH)
+
+def _load_names() -> None:
+    with open(NAMES_PATH, encoding="utf-8") as f:
+        saved = json.load(f)
+    if "names" not in saved:  # 예전 형식 {티커: 이름}: 조회 시각을 모르므로 전부 재확인 대상
+        saved = {"names": saved, "updated_at": {}}
+    _names.update(saved["names"])
+    _names_at.update(saved["updated_at"])
+
+def _lookup_name(ticker: str) -> Optional[str]:
     try:
-        return default if x is None or (isinstance(x, float) and math.isnan(x)) else float(x)
+        name = stock.get_market_ticker_name(ticker)
     except Exception:
-        return default
+        return None  # 다음 요청에서 다시 시도
+    return name if isinstance(name, str) and name else None
+
+def load_ticker_names(tickers) -> None:
+    """사전에 없는 티커만 골라 종목명을 조회해서 채움"""
+    global _names_loaded
+    with _names_lock:
+        if not _names_loaded:
+            if os.path.exists(NAMES_PATH):
+                _load_names()
+            _names_loaded = True
+        missing = [t for t in tickers if t not in _names]
+        if not missing:
+            return
+        # 종목명 조회는 티커당 1회라 첫 적재 때 수백 건 → 스레드 풀에서 동시에
+        jobs = [_ingest_pool.submit(contextvars.copy_context().run, _lookup_name, t) for t in missing]
+        added = False
+        now = time.time()
+        for t, job in zip(missing, jobs):
+            name = job.result()
+            if name:
+                _names[t] = name
+                _names_at[t] = now
+                added = True
+        if added:
+            _save_names()
+
+def _refresh_names(tickers: List[str]) -> None:
+    # 백그라운드 스레드에서 하나씩 (요청 경로의 ingest 풀을 막지 않도록)
+    found = {t: _lookup_name(t) for t in tickers}
+    now = time.time()
+    with _names_lock:
+        for t, name in found.items():
+            if name:
+                _names[t] = name
+                _names_at[t] = now
+        _save_names()
+
+def _ensure_listing_names(market: str, d: str, df: pd.DataFrame) -> None:
+    """시장별로 거래일이 바뀔 때 한 번: 새 티커는 바로 조회, 오래된 이름은 백그라운드에서 재조회"""
+    global _names_refresh
+    if df.empty or _names_checked.get(market) == d:
+        return
+    load_ticker_names(df.index)
+    with _names_lock:
+        if _names_refresh is not None and _names_refresh.is_alive():
+            return  # 진행 중인 재조회가 끝난 뒤 다음 요청에서 다시 확인
+        _names_checked[market] = d
+        cutoff = time.time() - NAMES_TTL_SEC
+        stale = [t for t in df.index if _names_at.get(t, 0.0) < cutoff]
+        if stale:
+            _names_refresh = threading.Thread(
+                target=_refresh_names, args=(stale,), name="names-refresh", daemon=True
+            )
+            _names_refresh.start()
+
+def ticker_names(tickers) -> List[str]:
+    tickers = [str(t) for t in tickers]
+    if not _names_loaded or any(t not in _names for t in tickers):
+        load_ticker_names(tickers)
+    return [_names.get(t, t) for t in tickers]
+
+def _int_col(df: pd.DataFrame, *names: str) -> List[int]:
+    # 먼저 있는 컬럼 사용, NaN → 0
+    for name in names:
+        if name in df.columns:
+            v = df[name].to_numpy()
+            if v.dtype.kind == "f":
+                v = np.nan_to_num(v.astype(np.float64), nan=0.0)
+            return v.astype(np.int64).tolist()
+    return [0] * len(df)
+
+def _float_col(df: pd.DataFrame, *names: str) -> List[float]:
+    for name in names:
+        if name in df.columns:
+            v = df[name].to_numpy()
+            f32 = v.dtype == np.float32
+            v = np.nan_to_num(v.astype(np.float64), nan=0.0)
+            # 스냅샷의 float32 컬럼은 float64로 올리면서 생기는 꼬리(8.66 → 8.6599998) 제거
+            return (np.round(v, 6) if f32 else v).tolist()
+    return [0.0] * len(df)
 
 def to_items(df: pd.DataFrame, top: int = 10) -> List[Dict]:
-    out = []
-    df = df.copy()
-    if "등락률" in df.columns:
-        df["등락률"] = df["등락률"].fillna(0)
-    for i, (ticker, row) in enumerate(df.head(top).iterrows(), start=1):
-        name = stock.get_market_ticker_name(ticker)
-        out.append({
-            "id": str(i),
-            "ticker": ticker,
-            "name": name,
-            "price": _as_int(row.get("종가", 0)),
-            "change": _as_float(row.get("지표", row.get("등락률", 0.0))),
-            "volume": _as_int(row.get("거래량", 0)),
-            "value": _as_int(row.get("거래대금", row.get("값", 0))),  # 거래대금/거래량 등 금액성 보조 값
-        })
+    # 상위 top 행만 컬럼 단위로 한 번에 변환
+    df = df.head(top)
+    if df.empty:
+        return []
+    tickers = [str(t) for t in df.index]
+    columns = zip(
+        tickers,
+        ticker_names(tickers),
+        _int_col(df, "종가"),
+        _float_col(df, "지표", "등락률"),
+        _int_col(df, "거래량"),
+        _int_col(df, "거래대금", "값"),  # 거래대금/거래량 등 금액성 보조 값
+    )
+    return [
+        {"id": str(i), "ticker": t, "name": name, "price": price, "change": change, "volume": volume, "value": value}
+        for i, (t, name, price, change, volume, value) in enumerate(columns, start=1)
+    ]
+
+# ===== 스크린 쿼리 =====
+# where/order 식을 파이썬 ast로 파싱해서 허용된 노드만 남긴 뒤 한 번 컴파일해 두고,
+# 최신 거래일 전 종목 배열(numpy) 위에서 한 번에 평가한다.
+#
+# 사용 가능한 이름
+#   스냅샷 컬럼    종가, 거래량, 거래대금, 등락률, 시가총액, PER, PBR, DIV ...
+#   <컬럼>_<n>     n 거래일 전 값 (예: 종가_1, 등락률_1, 거래량_1)
+#   RET_<n>        최근 n 거래일 누적 수익률(%)
+#   VOLR_<n>       오늘 거래량 / 직전 n 거래일 평균 거래량
+#   VOL_STD_<n>    최근 n 거래일 일간 수익률 표준편차(%)
+#   MC_RANK        시가총액 순위 (1 = 최대)
+# 연산: + - * / % **, 비교(연쇄 가능: 종가_2 < 종가_1 < 종가), and/or/not (&, |, ! 도 가능)
+# 함수: abs, log, sqrt, min, max (원소별)
+QUERY_FUNCS = {"abs": np.abs, "log": np.log, "sqrt": np.sqrt, "min": np.minimum, "max": np.maximum}
+QUERY_MAX_LOOKBACK = 250   # 파생 컬럼이 참조할 수 있는 최대 거래일 수
+
+_DERIVED_RE = re.compile(r"^(RET|VOLR|VOL_STD)_(\d+)$")
+_LAG_RE = re.compile(r"^(.+)_(\d+)$")
+_QUERY_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow,
+    ast.Compare, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq,
+    ast.Name, ast.Load, ast.Constant, ast.Call,
+)
+
+class QueryError(ValueError):
+    pass
+
+class _Vectorize(ast.NodeTransformer):
+    # and/or/not 과 연쇄 비교는 배열에 그대로 쓸 수 없으므로 &, |, ~ 로 바꿈
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        return functools.reduce(lambda a, b: ast.BinOp(a, op, b), node.values)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(ast.Invert(), node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        lefts = [node.left] + node.comparators[:-1]
+        parts = [ast.Compare(l, [op], [r]) for l, op, r in zip(lefts, node.ops, node.comparators)]
+        return functools.reduce(lambda a, b: ast.BinOp(a, ast.BitAnd(), b), parts)
+
+    def visit_Constant(self, node):
+        # 숫자 리터럴은 float 으로: 9**9**9 같은 식이 거대한 정수를 계산하지 않고 overflow 오류로 끝나도록
+        try:
+            return ast.Constant(float(node.value))
+        except OverflowError:
+            raise QueryError(f"literal out of range: {node.value}")
+
+@functools.lru_cache(maxsize=256)
+def compile_expr(text: str) -> Tuple[Any, frozenset]:
+    """식 → (코드 객체, 참조하는 컬럼 이름들). 같은 식은 한 번만 컴파일."""
+    text = re.sub(r"&&?", " and ", text)
+    text = re.sub(r"\|\|?", " or ", text)
+    text = re.sub(r"!(?!=)", " not ", text)
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError as e:
+        raise QueryError(f"syntax error: {e.msg}")
+    names = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _QUERY_NODES):
+            raise QueryError(f"unsupported syntax: {type(node).__name__}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise QueryError(f"unsupported literal: {node.value!r}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in QUERY_FUNCS or node.keywords:
+                raise QueryError("only abs, log, sqrt, min, max calls are allowed")
+        elif isinstance(node, ast.Name) and node.id not in QUERY_FUNCS:
+            names.add(node.id)
+    tree = ast.fix_missing_locations(_Vectorize().visit(tree))
+    return compile(tree, "<query>", "eval"), frozenset(names)
+
+def _eval_expr(text: str, column: Callable[[str], np.ndarray], shape: tuple) -> np.ndarray:
+    code, names = compile_expr(text)
+    env = {"__builtins__": {}, **QUERY_FUNCS, **{name: column(name) for name in names}}
+    try:
+        with np.errstate(all="ignore"):
+            out = eval(code, env)
+    except QueryError:
+        raise
+    except Exception as e:
+        raise QueryError(f"cannot evaluate '{text}': {e}")
+    return np.broadcast_to(np.asarray(out), shape)
+
+def _f64(values: np.ndarray) -> np.ndarray:
+    # float32 스냅샷 값은 꼬리(8.66 → 8.6599998) 없이 float64로
+    if values.dtype == np.float32:
+        return values.astype(np.float64).round(6)
+    return values.astype(np.float64)
+
+def _top_k_indices(values: np.ndarray, k: int, ascending: bool = False) -> np.ndarray:
+    """상위 k개 위치를 정렬해서 반환 (전체 정렬 대신 argpartition). NaN 제외."""
+    idx = np.flatnonzero(~np.isnan(values))
+    key = values[idx] if ascending else -values[idx]
+    if k <= 0:
+        return idx[:0]
+    if k < len(idx):
+        part = np.argpartition(key, k - 1)[:k]
+        idx, key = idx[part], key[part]
+    return idx[np.argsort(key, kind="stable")]
+
+def check_market(market: str) -> str:
+    market = market.upper()
+    if market != "ALL" and market not in MARKETS:
+        raise HTTPException(status_code=400, detail=f"unknown market: {market} (KOSPI, KOSDAQ, ALL)")
+    return market
+
+class ScreenContext:
+    """한 요청(또는 배치) 동안 거래일 목록/스냅샷/패널/쿼리 컬럼을 한 번만 읽어서 공유"""
+
+    def __init__(self, market: str = "KOSPI"):
+        self.market = market
+        self._bdays: Dict[int, List[str]] = {}
+        self._frames: Dict[str, pd.DataFrame] = {}
+        self._panels: Dict[tuple, pd.DataFrame] = {}
+        self._columns: Dict[str, np.ndarray] = {}
+
+    def bdays(self, n: int) -> List[str]:
+        if n not in self._bdays:
+            self._bdays[n] = recent_bdays(n)
+        return self._bdays[n]
+
+    def frame(self, d: str) -> pd.DataFrame:
+        if d not in self._frames:
+            self._frames[d] = snapshot(d, self.market)
+        return self._frames[d]
+
+    def latest(self) -> pd.DataFrame:
+        ds = self.bdays(1)
+        if not ds:
+            return pd.DataFrame()
+        df = self.frame(ds[-1])
+        _ensure_listing_names(self.market, ds[-1], df)  # 최신 상장 종목 기준으로 종목명 사전 갱신
+        return df
+
+    def panel(self, field: str, dates: List[str]) -> pd.DataFrame:
+        key = (field, tuple(dates))
+        if key not in self._panels:
+            self._panels[key] = panel(field, dates, self.market)
+        return self._panels[key]
+
+    def column(self, name: str) -> np.ndarray:
+        """쿼리 이름 → 최신 거래일 종목 순서에 맞춘 float64 배열"""
+        if name not in self._columns:
+            self._columns[name] = self._resolve(name)
+        return self._columns[name]
+
+    def _recent(self, field: str, n: int) -> np.ndarray:
+        # 최근 n 거래일 × 최신 종목 (마지막 행이 최신 거래일)
+        if n > QUERY_MAX_LOOKBACK:
+            raise QueryError(f"lookback over {QUERY_MAX_LOOKBACK} days is not supported")
+        tickers = self.latest().index
+        ds = self.bdays(n)
+        if len(ds) < n:
+            return np.full((n, len(tickers)), np.nan)
+        return _f64(self.panel(field, ds).reindex(columns=tickers).to_numpy())
+
+    def _resolve(self, name: str) -> np.ndarray:
+        df = self.latest()
+        if name in df.columns:
+            return _f64(df[name].to_numpy())
+        if name == "MC_RANK":
+            if "시가총액" not in df.columns:
+                raise QueryError("unknown column: 시가총액")
+            return df["시가총액"].rank(ascending=False, method="first").to_numpy(dtype=np.float64)
+        m = _DERIVED_RE.match(name)
+        if m:
+            kind, n = m.group(1), int(m.group(2))
+            if n < 1:
+                raise QueryError(f"{name}: window must be at least 1")
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if kind == "RET":
+                    return (np.prod(1.0 + self._recent("등락률", n) / 100.0, axis=0) - 1.0) * 100.0
+                if kind == "VOLR":
+                    v = self._recent("거래량", n + 1)
+                    return v[-1] / v[:-1].mean(axis=0)
+            return rolling_std(self._recent("등락률", n), n)[-1]
+        m = _LAG_RE.match(name)
+        if m and m.group(1) in df.columns:
+            return self._recent(m.group(1), int(m.group(2)) + 1)[0]
+        raise QueryError(f"unknown column: {name}")
+
+    def evaluate(self, text: str) -> np.ndarray:
+        return _eval_expr(text, self.column, (len(self.latest()),))
+
+def run_query(
+    ctx: ScreenContext,
+    where: str = "",
+    order: str = "등락률",
+    desc: bool = True,
+    metric: Optional[str] = None,
+    limit: int = 10,
+) -> pd.DataFrame:
+    """where 조건을 만족하는 종목 중 order 기준 상위 limit 행 (지표 = metric, 생략 시 order 값)"""
+    df = ctx.latest()
+    if df.empty:
+        return pd.DataFrame()
+    key = ctx.evaluate(order).astype(np.float64)
+    if where.strip():
+        mask = ctx.evaluate(where)
+        if mask.dtype != np.bool_:
+            raise QueryError("where must be a condition")
+        key = np.where(mask, key, np.nan)
+    idx = _top_k_indices(key, limit, ascending=not desc)
+    shown = key if metric is None else ctx.evaluate(metric).astype(np.float64)
+    return df.iloc[idx].assign(지표=shown[idx])
+
+# ===== 카테고리 스크린 =====
+# 기존 카테고리는 모두 쿼리 프리셋. where/order/metric 의 {이름} 은 params 값으로 치환.
+_LIQUID = "종가 >= {min_price} and 거래량 > 0"
+
+PRESETS: Dict[str, Dict[str, Any]] = {
+    # 1) 상승률 TOP10
+    "top-gainers": {
+        "where": _LIQUID, "order": "등락률", "desc": True,
+        "params": {"limit": 10, "min_price": 1000},
+    },
+    # 2) 하락률 TOP10 (오름차순: 가장 많이 하락)
+    "top-losers": {
+        "where": _LIQUID, "order": "등락률", "desc": False,
+        "params": {"limit": 10, "min_price": 1000},
+    },
+    # 3) 거래량 급증 TOP10 (전일 대비 증가율로 정렬)
+    "volume-surge": {
+        "where": _LIQUID + " and 거래량_1 > 0", "order": "(거래량 / 거래량_1 - 1) * 100", "desc": True,
+        "params": {"limit": 10, "min_price": 1000},
+    },
+    # 4) 3일 연속 상승 TOP10 (C0 < C1 < C2 < 오늘 종가)
+    "three-up": {
+        "where": _LIQUID + " and 종가_3 < 종가_2 < 종가_1 < 종가", "order": "등락률", "desc": True,
+        "params": {"limit": 10, "min_price": 1000},
+    },
+    # 5) 급락 후 반등 TOP10
+    "bounce-after-plunge": {
+        "where": _LIQUID + " and 등락률_1 <= {plunge_pct} and 등락률 > 0", "order": "등락률", "desc": True,
+        "params": {"limit": 10, "min_price": 1000, "plunge_pct": -3.0},
+    },
+    # 6) 거래대금 TOP10
+    "top-by-trading-value": {
+        "where": "", "order": "거래대금", "desc": True,
+        "params": {"limit": 10},
+    },
+    # 7) 안정적 우량주 TOP10 (시총 상위 top_n_mc 중 최근 lookback_days 변동성 낮은 순)
+    "stable-bluechips": {
+        "where": "MC_RANK <= {top_n_mc} and " + _LIQUID, "order": "VOL_STD_{lookback_days}", "desc": False,
+        "params": {"limit": 10, "top_n_mc": 200, "min_price": 1000, "lookback_days": 20},
+    },
+    # 8) 배당수익률 TOP10 (DIV 내림차순)
+    "dividend-yield": {
+        "where": "DIV > 0 and " + _LIQUID, "order": "DIV", "desc": True,
+        "params": {"limit": 10, "min_price": 1000},
+    },
+    # 9) 저 PER TOP10
+    "low-per": {
+        "where": "PER > 0 and " + _LIQUID, "order": "PER", "desc": False,
+        "params": {"limit": 10, "min_price": 1000},
+    },
+    # 10) 저 PBR TOP10
+    "low-pbr": {
+        "where": "PBR > 0 and " + _LIQUID, "order": "PBR", "desc": False,
+        "params": {"limit": 10, "min_price": 1000},
+    },
+}
+
+def _screen_params(name: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """배치 요청의 파라미터를 프리셋 기본값 타입으로 변환"""
+    defaults = PRESETS[name]["params"]
+    out = {}
+    for key, value in (params or {}).items():
+        if key not in defaults:
+            raise HTTPException(status_code=400, detail=f"{name}: unknown parameter '{key}'")
+        try:
+            out[key] = type(defaults[key])(value)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"{name}: invalid value for '{key}'")
     return out
 
+def run_screen(name: str, ctx: Optional[ScreenContext] = None, **params) -> List[Dict]:
+    preset = PRESETS[name]
+    params = {**preset["params"], **params}
+    df = run_query(
+        ctx or ScreenContext(),
+        where=preset["where"].format(**params),
+        order=preset["order"].format(**params),
+        desc=preset["desc"],
+        limit=params["limit"],
+    )
+    return to_items(df, top=params["limit"])
+
+# ===== 응답 캐시 =====
+# (엔드포인트, 정규화된 파라미터, 기준 거래일) → 직렬화된 JSON + ETag.
+# - 크기 제한 LRU
+# - stale-while-revalidate: 만료된 항목은 일단 그대로 돌려주고 재계산은 백그라운드에서 한 번만
+# - 같은 키의 동시 미스는 한 요청만 계산하고 나머지는 결과를 기다림
+RESPONSE_CACHE_SIZE = 512
+
+class ResponseCache:
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._inflight: Dict[tuple, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="revalidate")
+
+    def get(self, key: tuple, compute: Callable[[], Any], ttl: Optional[float]) -> Dict[str, Any]:
+        """ttl=None 이면 만료 없음(확정된 거래일 데이터)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if ttl is not None and time.time() - entry["at"] >= ttl and key not in self._inflight:
+                    self._inflight[key] = threading.Event()
+                    self._executor.submit(self._revalidate, key, compute)
+                return entry
+            waiter = self._inflight.get(key)
+            if waiter is None:
+                self._inflight[key] = threading.Event()
+
+        if waiter is not None:
+            waiter.wait()
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry
+            return self._store(key, compute())  # 먼저 계산하던 요청이 실패한 경우
+        try:
+            return self._store(key, compute())
+        finally:
+            self._done(key)
+
+    def _revalidate(self, key: tuple, compute: Callable[[], Any]) -> None:
+        try:
+            self._store(key, compute())
+        except Exception:  # 이전 값을 계속 쓰고 다음 요청에서 재시도
+            logger.exception("revalidate %s failed", key[0])
+        finally:
+            self._done(key)
+
+    def _done(self, key: tuple) -> None:
+        with self._lock:
+            waiter = self._inflight.pop(key, None)
+        if waiter is not None:
+            waiter.set()
+
+    def _store(self, key: tuple, value: Any) -> Dict[str, Any]:
+        # FastAPI 기본 JSONResponse와 같은 직렬화
+        body = json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        entry = {
+            "value": value,
+            "body": body,
+            "etag": '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"',
+            "at": time.time(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+response_cache = ResponseCache()
+
+def _cache_key(endpoint: str, params: Dict[str, Any]) -> Tuple[tuple, Optional[float]]:
+    # 기준 거래일이 바뀌면 새 키. 장중(미확정) 데이터만 LIVE_TTL_SEC 후 재검증
+    # 확정 여부도 키에 넣어서, 장중에 계산한 항목이 장 마감 후 만료 없는 항목으로 남지 않게 함
+    ds = recent_bdays(1)
+    as_of = ds[-1] if ds else ""
+    final = bool(as_of) and _is_final(as_of)
+    return (endpoint, tuple(sorted(params.items())), as_of, final), (None if final else LIVE_TTL_SEC)
+
+def cached_screen(
+    name: str, ctx: Optional[ScreenContext] = None, market: str = "KOSPI", **params
+) -> Dict[str, Any]:
+    market = ctx.market if ctx is not None else check_market(market)
+    # 생략된 파라미터는 기본값으로 채워서 GET/배치 요청이 같은 키를 쓰도록
+    params = {**PRESETS[name]["params"], **params}
+    key, ttl = _cache_key(f"/screen/{name}", {**params, "market": market})
+    try:
+        return response_cache.get(key, lambda: {"data": run_screen(name, ctx or ScreenContext(market), **params)}, ttl)
+    except QueryError as e:  # 예: lookback_days 가 0 이거나 QUERY_MAX_LOOKBACK 초과
+        raise HTTPException(status_code=400, detail=f"{name}: {e}")
+
+def combined_entry(entries: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """스크린별 캐시 항목을 {"data": {이름: [...]}} 하나로. ETag 는 각 항목 ETag 로부터 계산."""
+    value = {"data": {name: entry["value"]["data"] for name, entry in entries.items()}}
+    tags = ",".join(f"{name}={entry['etag']}" for name, entry in entries.items()).encode("utf-8")
+    return {
+        "value": value,
+        "body": json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8"),
+        "etag": '"' + hashlib.blake2b(tags, digest_size=16).hexdigest() + '"',
+    }
+
+def etag_response(request: Request, entry: Dict[str, Any]) -> Response:
+    headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    if entry["etag"] in tags or "*" in tags:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
 # ===== 카테고리 엔드포인트 =====
 
-# 1) 상승률 TOP10
 @app.get("/screen/top-gainers")
-def screen_top_gainers(limit: int = 10, min_price: int = 1000):
-    df = kospi_ohlcv()
-    df = df[(df["종가"] >= min_price) & (df["거래량"] > 0)]
-    if "등락률" in df.columns:
-        df = df[df["등락률"].notna()]
-    df = df.sort_values("등락률", ascending=False)
-    df = df.assign(지표=df["등락률"])
-    return {"data": to_items(df, top=limit)}
-
-# 2) 하락률 TOP10
+def screen_top_gainers(request: Request, limit: int = 10, min_price: int = 1000, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("top-gainers", market=market, limit=limit, min_price=min_price))
+
 @app.get("/screen/top-losers")
-def screen_top_losers(limit: int = 10, min_price: int = 1000):
-    df = kospi_ohlcv()
-    df = df[(df["종가"] >= min_price) & (df["거래량"] > 0)]
-    if "등락률" in df.columns:
-        df = df[df["등락률"].notna()]
-    df = df.sort_values("등락률", ascending=True)  # 오름차순: 가장 많이 하락
-    df = df.assign(지표=df["등락률"])
-    return {"data": to_items(df, top=limit)}
-
-# 3) 거래량 급증 TOP10 (전일 대비 증가율로 정렬)
+def screen_top_losers(request: Request, limit: int = 10, min_price: int = 1000, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("top-losers", market=market, limit=limit, min_price=min_price))
+
 @app.get("/screen/volume-surge")
-def screen_volume_surge(limit: int = 10, min_price: int = 1000):
-    ds = recent_bdays(2)
-    if len(ds) < 2:
-        return {"data": []}
-    d_prev, d_today = ds[-2], ds[-1]
-    prev = stock.get_market_ohlcv_by_ticker(d_prev, market="KOSPI")[["거래량"]].rename(columns={"거래량":"V_prev"})
-    today_df = stock.get_market_ohlcv_by_ticker(d_today, market="KOSPI")
-    df = prev.join(today_df, how="inner")
-    df = df[(df["종가"] >= min_price) & (df["거래량"] > 0) & (df["V_prev"] > 0)]
-    df = df.assign(증가율=(df["거래량"] / df["V_prev"] - 1.0) * 100.0)
-    df = df.sort_values("증가율", ascending=False)
-    # 정렬 지표는 증가율, 표시값은 거래량(주)
-    df = df.assign(지표=df["증가율"], 값=df["거래량"])
-    return {"data": to_items(df, top=limit)}
-
-# 4) 3일 연속 상승 TOP10 (C0 < C1 < C2 < 오늘 종가)
+def screen_volume_surge(request: Request, limit: int = 10, min_price: int = 1000, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("volume-surge", market=market, limit=limit, min_price=min_price))
+
 @app.get("/screen/three-up")
-def screen_three_up(limit: int = 10, min_price: int = 1000):
-    ds = recent_bdays(4)
-    if len(ds) < 4:
-        return {"data": []}
-    d0, d1, d2, d3 = ds
-    c0 = stock.get_market_ohlcv_by_ticker(d0, market="KOSPI")[["종가"]].rename(columns={"종가":"C0"})
-    c1 = stock.get_market_ohlcv_by_ticker(d1, market="KOSPI")[["종가"]].rename(columns={"종가":"C1"})
-    c2 = stock.get_market_ohlcv_by_ticker(d2, market="KOSPI")[["종가"]].rename(columns={"종가":"C2"})
-    t3 = stock.get_market_ohlcv_by_ticker(d3, market="KOSPI")  # 오늘
-    df = c0.join(c1, how="inner").join(c2, how="inner").join(t3, how="inner")
-    df = df[(df["종가"] >= min_price) & (df["거래량"] > 0)]
-    df = df[(df["C0"] < df["C1"]) & (df["C1"] < df["C2"]) & (df["C2"] < df["종가"])]
-    if "등락률" in df.columns:
-        df = df[df["등락률"].notna()].sort_values("등락률", ascending=False)
-    df = df.assign(지표=df["등락률"])
-    return {"data": to_items(df, top=limit)}
-
-# 5) 급락 후 반등 TOP10
+def screen_three_up(request: Request, limit: int = 10, min_price: int = 1000, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("three-up", market=market, limit=limit, min_price=min_price))
+
 @app.get("/screen/bounce-after-plunge")
-def screen_bounce_after_plunge(limit: int = 10, min_price: int = 1000, plunge_pct: float = -3.0):
-    ds = recent_bdays(2)
-    if len(ds) < 2:
-        return {"data": []}
-    d_prev, d_today = ds[-2], ds[-1]
-
-    prev = stock.get_market_ohlcv_by_ticker(d_prev, market="KOSPI")[["등락률"]]\
-            .rename(columns={"등락률": "R_prev"})
-    today_df = stock.get_market_ohlcv_by_ticker(d_today, market="KOSPI")[["종가", "거래량", "거래대금", "등락률"]]\
-            .rename(columns={"등락률": "R_today"})
-
-    df = prev.join(today_df, how="inner")
-    df = df[(df["종가"] >= min_price) & (df["거래량"] > 0)]
-    df = df[df["R_prev"].notna() & df["R_today"].notna()]
-    df = df[(df["R_prev"] <= plunge_pct) & (df["R_today"] > 0)]
-    df = df.sort_values("R_today", ascending=False).assign(지표=lambda x: x["R_today"])
-    return {"data": to_items(df, top=limit)}
-
-# 6) 거래대금 TOP10
+def screen_bounce_after_plunge(
+    request: Request,
+    limit: int = 10,
+    min_price: int = 1000,
+    plunge_pct: float = -3.0,
+    market: str = "KOSPI",
+):
+    entry = cached_screen(
+        "bounce-after-plunge", market=market, limit=limit, min_price=min_price, plunge_pct=plunge_pct
+    )
+    return etag_response(request, entry)
+
 @app.get("/screen/top-by-trading-value")
-def screen_top_by_trading_value(limit: int = 10):
-    df = kospi_ohlcv().sort_values("거래대금", ascending=False)
-    df = df.assign(지표=df["거래대금"])  
-    return {"data": to_items(df, top=limit)}
+def screen_top_by_trading_value(request: Request, limit: int = 10, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("top-by-trading-value", market=market, limit=limit))
 
-# 7) 안정적 우량주 TOP10
 @app.get("/screen/stable-bluechips")
 def screen_stable_bluechips(
+    request: Request,
     limit: int = 10,
-    top_n_mc: int = 200,         # 시총 상위 범위
+    top_n_mc: int = 200,
     min_price: int = 1000,
-    lookback_days: int = 20,     # 변동성 산정 구간(영업일)
+    lookback_days: int = 20,
+    market: str = "KOSPI",
 ):
-    import numpy as np
-
-    # 최근 영업일 (시총, 현재가 기준일)
-    last_bday = recent_bdays(1, max_back_days=365)[-1]
-
-    # 시총 상위 추출
-    cap = stock.get_market_cap_by_ticker(last_bday, market="KOSPI")
-    if cap is None or cap.empty or "시가총액" not in cap.columns:
-        return {"data": []}
-    cap = cap.sort_values("시가총액", ascending=False).head(top_n_mc)
-
-    # 변동성 계산 기간 (영업일 lookback_days를 커버하도록 여유 있게 -60일)
-    # pykrx는 날짜 문자열 'YYYYMMDD'
-    base_dt = datetime.strptime(last_bday, "%Y%m%d")
-    start_dt = (base_dt - timedelta(days=60))  # 충분히 여유
-    start = start_dt.strftime("%Y%m%d")
-    end = last_bday
-
-    rows = []
-    # 각 티커별로 기간 데이터 조회 → 최근 lookback_days 영업일만 잘라서 수익률 std 계산
-    for ticker in cap.index.tolist():
+    entry = cached_screen(
+        "stable-bluechips", market=market,
+        limit=limit, top_n_mc=top_n_mc, min_price=min_price, lookback_days=lookback_days,
+    )
+    return etag_response(request, entry)
+
+@app.get("/screen/dividend-yield")
+def screen_dividend_yield(request: Request, limit: int = 10, min_price: int = 1000, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("dividend-yield", market=market, limit=limit, min_price=min_price))
+
+@app.get("/screen/low-per")
+def screen_low_per(request: Request, limit: int = 10, min_price: int = 1000, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("low-per", market=market, limit=limit, min_price=min_price))
+
+@app.get("/screen/low-pbr")
+def screen_low_pbr(request: Request, limit: int = 10, min_price: int = 1000, market: str = "KOSPI"):
+    return etag_response(request, cached_screen("low-pbr", market=market, limit=limit, min_price=min_price))
+
+# 여러 스크린을 한 번에: {"top-gainers": {"limit": 10}, "low-per": {"min_price": 5000}, ...}
+# 본문이 없으면 전체 스크린을 기본 파라미터로 계산. 시장은 ?market=KOSPI|KOSDAQ|ALL
+# 응답 ETag 는 스크린별 ETag 조합이라 If-None-Match 를 보내면 바뀐 게 없을 때 304
+@app.post("/screen/all")
+def screen_all(
+    request: Request, screens: Optional[Dict[str, Dict[str, Any]]] = Body(default=None), market: str = "KOSPI"
+):
+    screens = screens if screens is not None else {name: {} for name in PRESETS}
+    unknown = [name for name in screens if name not in PRESETS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown screens: {', '.join(unknown)}")
+    jobs = {name: _screen_params(name, params) for name, params in screens.items()}
+    ctx = ScreenContext(check_market(market))  # 모든 스크린이 같은 스냅샷/패널을 공유
+    entries = {name: cached_screen(name, ctx, **params) for name, params in jobs.items()}
+    return etag_response(request, combined_entry(entries))
+
+# 임의 조건 스크린: /screen/query?where=PER > 0 and RET_5 > 10&order=거래대금&limit=20
+@app.get("/screen/query")
+def screen_query(
+    request: Request,
+    where: str = "",
+    order: str = "등락률",
+    desc: bool = True,
+    metric: Optional[str] = None,
+    limit: int = 10,
+    market: str = "KOSPI",
+):
+    market = check_market(market)
+    params = {"where": where, "order": order, "desc": desc, "metric": metric, "limit": limit, "market": market}
+    key, ttl = _cache_key("/screen/query", params)
+
+    def compute():
+        df = run_query(ScreenContext(market), where=where, order=order, desc=desc, metric=metric, limit=limit)
+        return {"data": to_items(df, top=limit)}
+
+    try:
+        entry = response_cache.get(key, compute, ttl)
+    except QueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return etag_response(request, entry)
+
+# ===== 실시간 스트림 =====
+# ws://<host>/stream 에 접속해서 구독 메시지를 보내면 갱신분(diff)만 푸시 받는다.
+#   → {"subscribe": {"market": "KOSPI", "screens": {"top-gainers": {"limit": 10}}, "indices": ["KOSPI", "KOSDAQ"]}}
+#   → {"unsubscribe": {"market": "KOSPI", "screens": ["top-gainers"], "indices": ["KOSPI"]}}
+#   ← {"type": "screen", "market", "screen", "params", "data"}            구독 직후 전체
+#   ← {"type": "screen-diff", "market", "screen", "params", "upsert", "remove", "order"}
+#   ← {"type": "index", "data"} / {"type": "index-diff", "upsert"}
+#   ← {"type": "error", "detail"}
+# 스크린은 (시장, 이름, 파라미터) 토픽마다 갱신 주기당 한 번만 계산하고 같은 diff를 모든 구독자에게 보냄.
+STREAM_INTERVAL_SEC = 5    # 토픽 재계산/지수 확인 주기(초). 실제 재계산은 응답 캐시 TTL을 따름
+STREAM_QUEUE_SIZE = 256    # 구독자별 미전송 메시지 한도. 넘치면 연결을 끊어 재접속 유도
+
+def _diff_items(old: List[Dict], new: List[Dict], key: str) -> Dict[str, Any]:
+    old_by_key = {x[key]: x for x in old}
+    new_keys = [x[key] for x in new]
+    diff: Dict[str, Any] = {}
+    upsert = [x for x in new if old_by_key.get(x[key]) != x]
+    remove = [k for k in old_by_key if k not in set(new_keys)]
+    if upsert:
+        diff["upsert"] = upsert
+    if remove:
+        diff["remove"] = remove
+    if [x[key] for x in old] != new_keys:
+        diff["order"] = new_keys
+    return diff
+
+class StreamSubscriber:
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.topics: Set[tuple] = set()
+        self.indices: Set[str] = set()
+        self.overflowed = False
+
+    def push(self, msg: Dict[str, Any]) -> None:
         try:
-            df = stock.get_market_ohlcv_by_date(start, end, ticker)
-            if df is None or df.empty or "종가" not in df.columns:
-                continue
-            # 최근 lookback_days만 사용 (영업일 개수 충분치 않으면 스킵)
-            if len(df) < lookback_days + 1:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+class StreamHub:
+    def __init__(self):
+        self.subscribers: Set[StreamSubscriber] = set()
+        self.topics: Dict[tuple, Dict[str, Any]] = {}   # 토픽 → {"market", "name", "params", "data", "subscribers"}
+        self.indices: Dict[str, Dict] = {}               # 마지막으로 보낸 지수 값
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def topic_key(market: str, name: str, params: Dict[str, Any]) -> tuple:
+        return (market, name, tuple(sorted({**PRESETS[name]["params"], **params}.items())))
+
+    async def _compute(self, key: tuple) -> List[Dict]:
+        market, name, params = key[0], key[1], dict(key[2])
+        entry = await asyncio.to_thread(cached_screen, name, None, market, **params)
+        return entry["value"]["data"]
+
+    async def subscribe(self, sub: StreamSubscriber, request: Dict[str, Any]) -> None:
+        market = request.get("market") or "KOSPI"
+        screens = request.get("screens") or {}
+        if isinstance(screens, list):
+            screens = {name: {} for name in screens}
+        if not isinstance(market, str) or not isinstance(screens, dict):
+            raise HTTPException(status_code=400, detail="market must be a string and screens an object or list")
+        market = check_market(market)
+        unknown = [name for name in screens if name not in PRESETS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"unknown screens: {', '.join(unknown)}")
+        for name, params in screens.items():
+            if params is not None and not isinstance(params, dict):
+                raise HTTPException(status_code=400, detail=f"{name}: parameters must be an object")
+            key = self.topic_key(market, name, _screen_params(name, params))
+            topic = self.topics.get(key)
+            if topic is None:
+                # 계산에 성공한 토픽만 등록 (실패한 토픽이 남아 주기마다 재계산되지 않도록)
+                data = await self._compute(key)
+                topic = self.topics.setdefault(key, {
+                    "market": market, "name": name, "params": dict(key[2]), "data": data, "subscribers": set(),
+                })
+            topic["subscribers"].add(sub)
+            sub.topics.add(key)
+            sub.push({
+                "type": "screen", "market": market, "screen": name, "params": topic["params"], "data": topic["data"],
+            })
+
+        names = [n for n in request.get("indices") or [] if n in INDEX_MAP]
+        if names:
+            sub.indices.update(names)
+            current = _market_summary["data"] or []
+            sub.push({"type": "index", "data": [x for x in current if x["name"] in names]})
+
+    def unsubscribe(self, sub: StreamSubscriber, request: Dict[str, Any]) -> None:
+        market = (request.get("market") or "KOSPI").upper()
+        names = set(request.get("screens") or [])
+        for key in [k for k in sub.topics if k[0] == market and k[1] in names]:
+            self._leave(sub, key)
+        sub.indices.difference_update(request.get("indices") or [])
+
+    def _leave(self, sub: StreamSubscriber, key: tuple) -> None:
+        sub.topics.discard(key)
+        topic = self.topics.get(key)
+        if topic is not None:
+            topic["subscribers"].discard(sub)
+            if not topic["subscribers"]:
+                del self.topics[key]  # 구독자가 없는 토픽은 더 이상 계산하지 않음
+
+    def connect(self) -> StreamSubscriber:
+        sub = StreamSubscriber()
+        self.subscribers.add(sub)
+        return sub
+
+    def disconnect(self, sub: StreamSubscriber) -> None:
+        for key in list(sub.topics):
+            self._leave(sub, key)
+        self.subscribers.discard(sub)
+
+    async def refresh(self) -> None:
+        for key, topic in list(self.topics.items()):
+            try:
+                data = await self._compute(key)
+            except Exception:
+                logger.exception("stream refresh %s failed", key[1])
                 continue
+            diff = _diff_items(topic["data"] or [], data, "ticker")
+            topic["data"] = data
+            if diff:
+                msg = {
+                    "type": "screen-diff", "market": topic["market"], "screen": topic["name"],
+                    "params": topic["params"], **diff,
+                }
+                for sub in list(topic["subscribers"]):
+                    sub.push(msg)
+
+        current = {x["name"]: x for x in _market_summary["data"] or []}
+        changed = [x for name, x in current.items() if self.indices.get(name) != x]
+        self.indices = current
+        if changed:
+            for sub in list(self.subscribers):
+                upsert = [x for x in changed if x["name"] in sub.indices]
+                if upsert:
+                    sub.push({"type": "index-diff", "upsert": upsert})
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(STREAM_INTERVAL_SEC)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("stream refresh failed")
+
+stream_hub = StreamHub()
 
-            # 뒤에서 N개만 사용
-            df_tail = df.tail(lookback_days + 1)
-            # 일간 수익률(%) 계산
-            close = df_tail["종가"].astype(float)
-            rets = close.pct_change().dropna() * 100.0
-            if len(rets) < lookback_days:
+@app.on_event("startup")
+async def _start_stream_hub():
+    stream_hub._task = asyncio.create_task(stream_hub.run())
+
+@app.on_event("shutdown")
+async def _stop_stream_hub():
+    if stream_hub._task is not None:
+        stream_hub._task.cancel()
+
+async def _stream_sender(ws: WebSocket, sub: StreamSubscriber) -> None:
+    while True:
+        try:
+            msg = await asyncio.wait_for(sub.queue.get(), timeout=STREAM_INTERVAL_SEC)
+        except asyncio.TimeoutError:
+            msg = None
+        if sub.overflowed:
+            await ws.close(code=1013)  # 너무 느린 클라이언트: 재접속해서 전체부터 다시 받기
+            return
+        if msg is not None:
+            await ws.send_json(msg)
+
+@app.websocket("/stream")
+async def stream(ws: WebSocket):
+    await ws.accept()
+    sub = stream_hub.connect()
+    sender = asyncio.create_task(_stream_sender(ws, sub))
+    try:
+        while True:
+            try:
+                request = json.loads(await ws.receive_text())
+            except (KeyError, ValueError):  # 바이너리 프레임 / JSON 아님
+                request = None
+            if not isinstance(request, dict):
+                sub.push({"type": "error", "detail": "message must be a JSON object"})
                 continue
+            try:
+                for op in ("subscribe", "unsubscribe"):
+                    if op in request and not isinstance(request[op] or {}, dict):
+                        raise HTTPException(status_code=400, detail=f"{op} must be an object")
+                if "subscribe" in request:
+                    await stream_hub.subscribe(sub, request["subscribe"] or {})
+                if "unsubscribe" in request:
+                    stream_hub.unsubscribe(sub, request["unsubscribe"] or {})
+            except (HTTPException, QueryError) as e:
+                sub.push({"type": "error", "detail": getattr(e, "detail", str(e))})
+            except (TypeError, AttributeError):  # 필드 타입이 맞지 않는 메시지
+                sub.push({"type": "error", "detail": "invalid request"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        stream_hub.disconnect(sub)
+        sender.cancel()
 
-            vol_std = float(rets.std(ddof=0))  # 표준편차 (%)
-            last_row = df_tail.iloc[-1]
-            price = float(last_row["종가"])
-            volume = int(last_row.get("거래량", 0))
-            value = int(last_row.get("거래대금", 0))
-
-            if price >= min_price and volume > 0:
-                rows.append({
-                    "ticker": ticker,
-                    "VOL_STD": vol_std,
-                    "종가": price,
-                    "거래량": volume,
-                    "거래대금": value,
-                })
-        except Exception:
-            # 개별 티커 에러는 그냥 스킵
-            continue
+# ===== 백테스트 =====
+# 프리셋 스크린을 과거 모든 거래일에 대해 한 번에 평가하고 편입 종목의 1/5/20일 후 수익률을 집계.
+# 거래일 × 종목 패널(필드별 (T, N) 배열)을 한 번 적재해 두고, 쿼리 식을 2차원 배열 위에서
+# 그대로 평가하므로 날짜별 루프/조인이 없다. 결과는 응답 캐시에 (스크린, 파라미터)별로 저장.
+BACKTEST_MAX_MONTHS = 60
+BACKTEST_MAX_HORIZON = 60
+BACKTEST_PREFETCH_WORKERS = 4   # 날짜별 스냅샷 동시 적재 (각 날짜는 다시 ingest 풀에서 시장×테이블 병렬)
 
-    if not rows:
-        return {"data": []}
+_backtest_pool = ThreadPoolExecutor(max_workers=BACKTEST_PREFETCH_WORKERS, thread_name_prefix="backtest")
 
-    # 낮은 변동성 순 정렬 후 상위 limit
-    out_df = pd.DataFrame(rows).sort_values("VOL_STD", ascending=True)
-    
-    # ticker를 인덱스로 세팅 
-    if "ticker" in out_df.columns:
-        out_df = out_df.set_index("ticker")
+def _shift_rows(x: np.ndarray, n: int) -> np.ndarray:
+    # n 행 아래로 밀기 (t 행 = t-n 행 값)
+    out = np.full(x.shape, np.nan)
+    if n < x.shape[0]:
+        out[n:] = x[:x.shape[0] - n]
+    return out
 
+def _rolling_sum(x: np.ndarray, window: int) -> np.ndarray:
+    """(T, N) 열별 이동 합. 창 안에 결측이 있으면 NaN."""
+    valid = ~np.isnan(x)
+    pad = np.zeros((1, x.shape[1]))
+    c = np.cumsum(np.vstack([pad, np.where(valid, x, 0.0)]), axis=0)
+    cn = np.cumsum(np.vstack([pad, valid]), axis=0)
+    out = np.full(x.shape, np.nan)
+    if 0 < window <= x.shape[0]:
+        full = (cn[window:] - cn[:-window]) == window
+        out[window - 1:] = np.where(full, c[window:] - c[:-window], np.nan)
+    return out
 
-    # to_items로 변환 (지표=VOL_STD)
-    out_df = out_df.assign(지표=out_df["VOL_STD"])
-    return {"data": to_items(out_df, top=limit)}
+def _name_lookback(name: str) -> int:
+    """쿼리 이름이 과거 몇 거래일 전 데이터까지 참조하는지"""
+    m = _DERIVED_RE.match(name)
+    if m:
+        n = int(m.group(2))
+        return n if m.group(1) == "VOLR" else n - 1
+    m = _LAG_RE.match(name)
+    if m and m.group(1) in INT_COLS + FLOAT_COLS:
+        return int(m.group(2))
+    return 0
 
-# 8) 배당수익률 TOP10 (DIV 내림차순)
-@app.get("/screen/dividend-yield")
-def screen_dividend_yield(limit: int = 10, min_price: int = 1000):
-    d = today()
-    ohlcv = kospi_ohlcv(d)
-    f = stock.get_market_fundamental(d, market="KOSPI")
-    df = ohlcv.join(f, how="inner")
-    col = "DIV" if "DIV" in df.columns else None
-    if col is None:
-        return {"data": []}
-    df = df[(df[col] > 0) & (df["종가"] >= min_price) & (df["거래량"] > 0)]
-    df = df.sort_values(col, ascending=False).assign(지표=lambda x: x[col])
-    return {"data": to_items(df, top=limit)}
-
-# 9) 저 PER TOP10
-@app.get("/screen/low-per")
-def screen_low_per(limit: int = 10, min_price: int = 1000):
-    d = today()
-    ohlcv = kospi_ohlcv(d)
-    f = stock.get_market_fundamental(d, market="KOSPI")
-    df = ohlcv.join(f, how="inner")
-    df = df[(df["PER"] > 0) & (df["종가"] >= min_price) & (df["거래량"] > 0)]
-    df = df[df["PER"].notna()].sort_values("PER", ascending=True).assign(지표=lambda x: x["PER"])
-    return {"data": to_items(df, top=limit)}
-
-# 10) 저 PBR TOP10
-@app.get("/screen/low-pbr")
-def screen_low_pbr(limit: int = 10, min_price: int = 1000):
-    d = today()
-    ohlcv = kospi_ohlcv(d)
-    f = stock.get_market_fundamental(d, market="KOSPI")
-    df = ohlcv.join(f, how="inner")
-    df = df[(df["PBR"] > 0) & (df["종가"] >= min_price) & (df["거래량"] > 0)]
-    df = df[df["PBR"].notna()].sort_values("PBR", ascending=True).assign(지표=lambda x: x["PBR"])
-    return {"data": to_items(df, top=limit)}
+class PanelContext:
+    """ScreenContext 와 같은 쿼리 이름을 거래일 × 종목 (T, N) 배열로 계산"""
+
+    def __init__(self, dates: List[str], market: str = "KOSPI"):
+        self.dates = dates
+        self.market = market
+        self.tickers = panel("종가", dates, market).columns
+        self._columns: Dict[str, np.ndarray] = {}
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.dates), len(self.tickers))
+
+    def field(self, col: str) -> np.ndarray:
+        p = panel(col, self.dates, self.market)
+        if p.shape[1] == 0 and len(self.tickers):  # 어느 날짜 스냅샷에도 없는 컬럼
+            raise QueryError(f"unknown column: {col}")
+        return _f64(p.reindex(columns=self.tickers).to_numpy())
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            self._columns[name] = self._resolve(name)
+        return self._columns[name]
+
+    def _resolve(self, name: str) -> np.ndarray:
+        if name in INT_COLS + FLOAT_COLS:
+            return self.field(name)
+        if name == "MC_RANK":
+            caps = pd.DataFrame(self.field("시가총액"))
+            return caps.rank(axis=1, ascending=False, method="first").to_numpy(dtype=np.float64)
+        m = _DERIVED_RE.match(name)
+        if m:
+            kind, n = m.group(1), int(m.group(2))
+            if n < 1:
+                raise QueryError(f"{name}: window must be at least 1")
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if kind == "RET":
+                    return np.expm1(_rolling_sum(np.log1p(self.column("등락률") / 100.0), n)) * 100.0
+                if kind == "VOLR":
+                    v = self.column("거래량")
+                    return v / _shift_rows(_rolling_sum(v, n) / n, 1)
+            return rolling_std(self.column("등락률"), n)
+        m = _LAG_RE.match(name)
+        if m and m.group(1) in INT_COLS + FLOAT_COLS:
+            return _shift_rows(self.column(m.group(1)), int(m.group(2)))
+        raise QueryError(f"unknown column: {name}")
+
+    def evaluate(self, text: str) -> np.ndarray:
+        return _eval_expr(text, self.column, self.shape)
+
+def _forward_returns(rets: np.ndarray, h: int) -> np.ndarray:
+    """t 일 종가에 사서 t+h 일 종가까지의 누적 수익률(%). 구간에 결측이 있거나 미래가 없으면 NaN."""
+    s = _rolling_sum(np.log1p(rets / 100.0), h)   # s[t] = t-h+1..t 일 합
+    out = np.full(rets.shape, np.nan)
+    if h < rets.shape[0]:
+        out[:-h] = np.expm1(s[h:]) * 100.0
+    return out
+
+def _top_k_rows(key: np.ndarray, k: int, ascending: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """행(거래일)마다 상위 k 열 위치와 유효 여부. NaN 은 제외."""
+    s = key if ascending else -key
+    s = np.where(np.isnan(s), np.inf, s)
+    k = min(k, s.shape[1])
+    if k <= 0:  # _top_k_indices 와 같이 빈 선택 (limit=0 이면 라이브 스크린도 [])
+        empty = np.zeros((s.shape[0], 0), dtype=np.intp)
+        return empty, np.zeros(empty.shape, dtype=bool)
+    picks = np.argpartition(s, k - 1, axis=1)[:, :k]
+    return picks, np.isfinite(np.take_along_axis(s, picks, axis=1))
+
+def _round(x: float, nd: int = 4) -> Optional[float]:
+    return None if x is None or not np.isfinite(x) else round(float(x), nd)
+
+def run_backtest(
+    name: str, months: int = 12, horizons: Tuple[int, ...] = (1, 5, 20), market: str = "KOSPI", **params
+) -> Dict[str, Any]:
+    preset = PRESETS[name]
+    params = {**preset["params"], **params}
+    where = preset["where"].format(**params)
+    order = preset["order"].format(**params)
+
+    # 평가 구간 거래일 + 조건식이 참조하는 과거 거래일
+    names = set(compile_expr(order)[1]) | (set(compile_expr(where)[1]) if where.strip() else set())
+    lookback = max([_name_lookback(n) for n in names] + [0])
+    if lookback >= QUERY_MAX_LOOKBACK:  # 라이브 스크린(ScreenContext._recent)과 같은 한도
+        raise QueryError(f"lookback over {QUERY_MAX_LOOKBACK} days is not supported")
+    ds = recent_bdays(1)
+    if not ds:
+        return {"screen": name, "params": params, "dates": 0, "horizons": {}, "series": []}
+    start = (pd.Timestamp(ds[-1]) - pd.DateOffset(months=months)).strftime("%Y%m%d")
+    all_dates = bdays_before(ds[-1], 23 * months + lookback)   # 한 달 거래일은 23일 이하
+    first = bisect.bisect_right(all_dates, start)
+    first = max(first, lookback)
+    dates = all_dates[first - lookback:]
+
+    # 스냅샷을 날짜별로 동시에 적재해 두면 이후 패널 구성은 메모리/디스크만 읽음
+    # (결과는 버려서 memmap 을 붙잡지 않고, 업스트림 호출 집계를 위해 현재 컨텍스트를 넘김)
+    def prefetch(d: str) -> None:
+        snapshot(d, market)
+    jobs = [_backtest_pool.submit(contextvars.copy_context().run, prefetch, d) for d in dates]
+    for job in jobs:
+        job.result()
+    ctx = PanelContext(dates, market)
+
+    key = ctx.evaluate(order).astype(np.float64)
+    if where.strip():
+        mask = ctx.evaluate(where)
+        if mask.dtype != np.bool_:
+            raise QueryError("where must be a condition")
+        key = np.where(mask, key, np.nan)
+    key = key[lookback:]
+    picks, valid = _top_k_rows(key, params["limit"], ascending=not preset["desc"])
+    eval_dates = dates[lookback:]
+    rets = ctx.column("등락률")
+
+    stats, per_date = {}, {}
+    for h in horizons:
+        fwd = _forward_returns(rets, h)[lookback:]
+        picked = np.take_along_axis(fwd, picks, axis=1)
+        ok = valid & ~np.isnan(picked)
+        n = ok.sum(axis=1)
+        mean = np.where(n > 0, np.where(ok, picked, 0.0).sum(axis=1) / np.maximum(n, 1), np.nan)
+        # 비교 기준: 같은 날 전 종목 동일가중 평균
+        mkt_ok = ~np.isnan(fwd)
+        mkt_n = mkt_ok.sum(axis=1)
+        mkt = np.where(mkt_n > 0, np.where(mkt_ok, fwd, 0.0).sum(axis=1) / np.maximum(mkt_n, 1), np.nan)
+        days = ~np.isnan(mean)
+        stats[str(h)] = {
+            "dates": int(days.sum()),
+            "picks": int(n.sum()),
+            "mean_pct": _round(mean[days].mean()) if days.any() else None,
+            "median_pct": _round(np.median(mean[days])) if days.any() else None,
+            "hit_rate": _round((picked[ok] > 0).mean()) if ok.any() else None,
+            "market_mean_pct": _round(mkt[days].mean()) if days.any() else None,
+            "excess_pct": _round((mean[days] - mkt[days]).mean()) if days.any() else None,
+        }
+        per_date[h] = mean
+
+    series = [
+        {"date": d, "picks": int(valid[i].sum()), **{f"ret_{h}": _round(per_date[h][i]) for h in horizons}}
+        for i, d in enumerate(eval_dates)
+    ]
+    return {
+        "screen": name,
+        "market": market,
+        "params": params,
+        "from": eval_dates[0] if eval_dates else None,
+        "to": eval_dates[-1] if eval_dates else None,
+        "dates": len(eval_dates),
+        "horizons": stats,
+        "series": series,
+    }
+
+# /backtest/three-up?months=12&horizons=1,5,20&min_price=5000 (프리셋 파라미터는 쿼리로)
+@app.get("/backtest/{name}")
+def backtest(request: Request, name: str, months: int = 12, horizons: str = "1,5,20", market: str = "KOSPI"):
+    if name not in PRESETS:
+        raise HTTPException(status_code=404, detail=f"unknown screen: {name}")
+    if not 1 <= months <= BACKTEST_MAX_MONTHS:
+        raise HTTPException(status_code=400, detail=f"months must be 1..{BACKTEST_MAX_MONTHS}")
+    try:
+        hs = tuple(sorted({int(h) for h in horizons.split(",") if h.strip()}))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="horizons must be comma separated integers")
+    if not hs or not all(1 <= h <= BACKTEST_MAX_HORIZON for h in hs):
+        raise HTTPException(status_code=400, detail=f"horizons must be 1..{BACKTEST_MAX_HORIZON}")
+    market = check_market(market)
+    extra = {k: v for k, v in request.query_params.items() if k not in ("months", "horizons", "market")}
+    params = {**PRESETS[name]["params"], **_screen_params(name, extra)}
+
+    key, ttl = _cache_key(f"/backtest/{name}", {**params, "months": months, "horizons": hs, "market": market})
+    try:
+        entry = response_cache.get(
+            key, lambda: run_backtest(name, months=months, horizons=hs, market=market, **params), ttl
+        )
+    except QueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return etag_response(request, entry)
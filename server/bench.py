@@ -0,0 +1,289 @@
+# bench.py
+# app.py 오프라인 벤치마크. pykrx.stock / yfinance 를 가짜 모듈로 바꿔 끼우고
+# (고정 지연 주입 가능) 모든 /screen/* (POST /screen/all 포함) 와 /market/summary 를 동시 요청으로 두드려
+# p50/p99 지연, 처리량, 요청당 업스트림 호출 수를 출력한다.
+#
+#   python bench.py                                  # 합성 데이터, 업스트림 지연 50ms
+#   python bench.py --latency-ms 200 --concurrency 32 --requests 200
+#   python bench.py --record fixtures/               # 실제 pykrx/yfinance 응답을 녹화
+#   python bench.py --fixtures fixtures/             # 녹화본으로 재생 (네트워크 없음)
+#
+# 매 실행은 빈 임시 데이터 디렉터리에서 시작하므로 첫 요청(cold)은 스냅샷/캘린더 적재 비용을 포함한다.
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+N_TICKERS = {"KOSPI": 950, "KOSDAQ": 1700}
+TICKER_OFFSET = {"KOSPI": 0, "KOSDAQ": 100000}
+QUERY_SAMPLE = "where=RET_5 > 5 and VOLR_5 > 2&order=거래대금&limit=10"
+
+# ===== 녹화/재생 =====
+def _fixture_key(func: str, args, kwargs) -> str:
+    raw = repr((args, sorted(kwargs.items())))
+    return f"{func}-{hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]}.pkl"
+
+class Recorder:
+    """실제 모듈 호출을 그대로 통과시키면서 결과를 fixtures 디렉터리에 저장"""
+
+    def __init__(self, module, prefix: str, root: str):
+        self._module = module
+        self._prefix = prefix
+        self._root = root
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._module, name)
+        if not callable(attr) or isinstance(attr, type):
+            return attr
+
+        def call(*args, **kwargs):
+            out = attr(*args, **kwargs)
+            path = os.path.join(self._root, _fixture_key(f"{self._prefix}.{name}", args, kwargs))
+            with open(path, "wb") as f:
+                pickle.dump(out, f)
+            return out
+        return call
+
+class Replayer:
+    """녹화본에서 결과를 읽어 돌려줌. 호출마다 latency 만큼 대기"""
+
+    def __init__(self, prefix: str, root: str, latency: float):
+        self._prefix = prefix
+        self._root = root
+        self._latency = latency
+
+    def __getattr__(self, name: str):
+        def call(*args, **kwargs):
+            time.sleep(self._latency)
+            path = os.path.join(self._root, _fixture_key(f"{self._prefix}.{name}", args, kwargs))
+            if not os.path.exists(path):
+                raise KeyError(f"no fixture for {self._prefix}.{name}{args}")
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        return call
+
+# ===== 합성 데이터 =====
+class SyntheticStock:
+    """pykrx.stock 대역. 날짜/시장별로 결정적인 난수 데이터를 만듦 (주말은 휴장)"""
+
+    def __init__(self, latency: float, today: str):
+        self._latency = latency
+        self._today = today
+
+    def _is_bday(self, d: str) -> bool:
+        return datetime.strptime(d, "%Y%m%d").weekday() < 5 and d <= self._today
+
+    def _tickers(self, market: str):
+        off = TICKER_OFFSET[market]
+        return pd.Index([f"{off + i:06d}" for i in range(N_TICKERS[market])], name="티커")
+
+    def _rng(self, d: str, market: str, salt: int):
+        return np.random.default_rng(int(d) * 10 + salt + TICKER_OFFSET[market])
+
+    def get_market_ohlcv_by_ticker(self, d, market="KOSPI"):
+        time.sleep(self._latency)
+        if not self._is_bday(d):
+            return pd.DataFrame()
+        idx = self._tickers(market)
+        rng = self._rng(d, market, 0)
+        close = rng.integers(500, 300000, len(idx))
+        return pd.DataFrame({
+            "시가": close, "고가": close, "저가": close, "종가": close,
+            "거래량": rng.integers(0, 5_000_000, len(idx)),
+            "거래대금": rng.integers(0, 500_000_000_000, len(idx)),
+            "등락률": rng.normal(0, 3, len(idx)).round(2),
+        }, index=idx)
+
+    def get_market_cap_by_ticker(self, d, market="KOSPI"):
+        time.sleep(self._latency)
+        if not self._is_bday(d):
+            return pd.DataFrame()
+        idx = self._tickers(market)
+        rng = self._rng(d, market, 1)
+        return pd.DataFrame({
+            "시가총액": rng.integers(10**9, 5 * 10**14, len(idx)),
+            "상장주식수": rng.integers(10**6, 10**9, len(idx)),
+        }, index=idx)
+
+    def get_market_fundamental(self, d, market="KOSPI"):
+        time.sleep(self._latency)
+        if not self._is_bday(d):
+            return pd.DataFrame()
+        idx = self._tickers(market)
+        rng = self._rng(d, market, 2)
+        return pd.DataFrame({
+            "BPS": rng.integers(0, 200000, len(idx)), "PER": rng.uniform(-10, 60, len(idx)).round(2),
+            "PBR": rng.uniform(0, 6, len(idx)).round(2), "EPS": rng.integers(-5000, 20000, len(idx)),
+            "DIV": rng.uniform(0, 8, len(idx)).round(2), "DPS": rng.integers(0, 5000, len(idx)),
+        }, index=idx)
+
+    def get_index_ohlcv_by_date(self, fromdate, todate, ticker, *args, **kwargs):
+        time.sleep(self._latency)
+        days = pd.date_range(datetime.strptime(fromdate, "%Y%m%d"), datetime.strptime(todate, "%Y%m%d"))
+        days = [x for x in days if self._is_bday(x.strftime("%Y%m%d"))]
+        return pd.DataFrame({"종가": np.full(len(days), 2500.0)}, index=pd.DatetimeIndex(days, name="날짜"))
+
+    def get_market_ticker_name(self, ticker):
+        time.sleep(self._latency)
+        return f"종목{ticker}"
+
+class SyntheticYF:
+    """yfinance 대역. download 만 지원"""
+
+    def __init__(self, latency: float):
+        self._latency = latency
+
+    def download(self, symbols, **kwargs):
+        time.sleep(self._latency)
+        symbols = [symbols] if isinstance(symbols, str) else list(symbols)
+        idx = pd.bdate_range(end=datetime.now().date(), periods=7)
+        cols = pd.MultiIndex.from_product([["Close"], symbols])
+        rng = np.random.default_rng(len(symbols))
+        return pd.DataFrame(2500 + rng.normal(0, 20, (len(idx), len(cols))).cumsum(axis=0), index=idx, columns=cols)
+
+# ===== 설치 =====
+def _freeze_clock(app_module, today: str) -> None:
+    # 녹화본 재생 시 app 의 "오늘"을 녹화한 날로 고정 (장 마감 후 시각)
+    frozen = datetime.strptime(today, "%Y%m%d").replace(hour=20)
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return frozen
+
+    app_module.datetime = FrozenDatetime
+
+def install_upstream(args) -> str:
+    """pykrx.stock / yfinance 를 대역으로 바꿔 끼우고 기준일(YYYYMMDD)을 돌려줌"""
+    latency = args.latency_ms / 1000.0
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+        from pykrx import stock as real_stock
+        import yfinance as real_yf
+        fake_stock = Recorder(real_stock, "pykrx", args.record)
+        fake_yf = Recorder(real_yf, "yfinance", args.record)
+        today = datetime.now().strftime("%Y%m%d")
+        with open(os.path.join(args.record, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"today": today}, f)
+    elif args.fixtures:
+        with open(os.path.join(args.fixtures, "meta.json"), encoding="utf-8") as f:
+            today = json.load(f)["today"]
+        fake_stock = Replayer("pykrx", args.fixtures, latency)
+        fake_yf = Replayer("yfinance", args.fixtures, latency)
+    else:
+        today = datetime.now().strftime("%Y%m%d")
+        fake_stock = SyntheticStock(latency, today)
+        fake_yf = SyntheticYF(latency)
+
+    pykrx = types.ModuleType("pykrx")
+    pykrx.stock = fake_stock
+    sys.modules["pykrx"] = pykrx
+    sys.modules["pykrx.stock"] = fake_stock
+    sys.modules["yfinance"] = fake_yf
+    return today
+
+# ===== 부하 =====
+def _get(base: str, path: str, body: Optional[bytes] = None):
+    # body 가 있으면 JSON POST
+    req = urllib.request.Request(base + path, data=body, headers={"Content-Type": "application/json"} if body else {})
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=300) as res:
+            res.read()
+            status, calls = res.status, int(res.headers.get("X-Upstream-Calls", 0))
+    except urllib.error.HTTPError as e:
+        status, calls = e.code, int(e.headers.get("X-Upstream-Calls", 0))
+    return time.perf_counter() - t0, status, calls
+
+def bench_endpoint(base: str, path: str, requests: int, concurrency: int, body: Optional[bytes] = None) -> dict:
+    cold, status, cold_calls = _get(base, path, body)  # 첫 요청: 적재 비용 포함
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: _get(base, path, body), range(requests)))
+    wall = time.perf_counter() - t0
+    lat = np.array([r[0] for r in results]) * 1000.0
+    return {
+        "path": path if body is None else f"POST {path}",
+        "cold_ms": round(cold * 1000.0, 1),
+        "cold_upstream": cold_calls,
+        "p50_ms": round(float(np.percentile(lat, 50)), 2),
+        "p99_ms": round(float(np.percentile(lat, 99)), 2),
+        "rps": round(requests / wall, 1),
+        "upstream_per_req": round(sum(r[2] for r in results) / requests, 3),
+        "errors": sum(1 for r in results if r[1] >= 400) + int(status >= 400),
+    }
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def main():
+    parser = argparse.ArgumentParser(description="StockApp server benchmark (offline)")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="업스트림 호출당 주입 지연")
+    parser.add_argument("--requests", type=int, default=100, help="엔드포인트별 요청 수 (cold 요청 제외)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--market", default="KOSPI")
+    parser.add_argument("--fixtures", help="녹화본 디렉터리 (재생)")
+    parser.add_argument("--record", help="실제 업스트림 응답을 녹화할 디렉터리")
+    parser.add_argument("--json", action="store_true", help="결과를 JSON 으로 출력")
+    args = parser.parse_args()
+
+    os.environ["STOCKAPP_DATA_DIR"] = tempfile.mkdtemp(prefix="stockapp-bench-")
+    today = install_upstream(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+    if args.fixtures:
+        _freeze_clock(app_module, today)
+
+    import uvicorn
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    base = f"http://127.0.0.1:{port}"
+
+    market = urllib.parse.quote(args.market)
+    paths = ["/market/summary"]
+    paths += [f"/screen/{name}?market={market}" for name in app_module.PRESETS]
+    paths.append("/screen/query?" + urllib.parse.quote(QUERY_SAMPLE, safe="=&") + f"&market={market}")
+
+    rows = [bench_endpoint(base, p, args.requests, args.concurrency) for p in paths]
+    # 홈 화면이 실제로 쓰는 배치 요청 (CategorySwiper 와 같은 본문)
+    body = json.dumps({name: {"limit": 10} for name in app_module.PRESETS}).encode("utf-8")
+    rows.append(bench_endpoint(base, f"/screen/all?market={market}", args.requests, args.concurrency, body))
+    with urllib.request.urlopen(base + "/metrics") as res:
+        upstream = json.loads(res.read())["upstream"]
+    server.should_exit = True
+
+    if args.json:
+        print(json.dumps({"endpoints": rows, "upstream": upstream}, ensure_ascii=False, indent=2))
+        return
+    print(f"upstream latency {args.latency_ms:.0f}ms, {args.requests} req x {args.concurrency} concurrent\n")
+    print(f"{'endpoint':<46}{'cold ms':>9}{'cold up':>8}{'p50 ms':>9}{'p99 ms':>9}{'req/s':>9}{'up/req':>8}{'err':>5}")
+    for r in rows:
+        print(f"{r['path'][:45]:<46}{r['cold_ms']:>9}{r['cold_upstream']:>8}{r['p50_ms']:>9}"
+              f"{r['p99_ms']:>9}{r['rps']:>9}{r['upstream_per_req']:>8}{r['errors']:>5}")
+    print("\nupstream calls")
+    for label, s in upstream.items():
+        print(f"  {label:<40}{s['calls']:>7} calls  avg {s['avg_ms']:>8} ms")
+
+if __name__ == "__main__":
+    main()